@@ -0,0 +1,108 @@
+"""
+Load test of one serving replica of `MAGGIE.chain` against a fake backend: the synchronous path (`invoke`, one request
+per worker thread, as the model server runs it) against the async one (`ainvoke`, many requests per event loop,
+bounded by `async_serving.max_concurrent_requests`).
+
+Every call to the LLM, the embeddings and Vector Search waits `--latency` seconds. Closed-loop clients send requests
+back to back with distinct questions (no cache hits); for each number of clients the benchmark reports the throughput
+and the latency percentiles, so the throughput at a given p95 can be read from the table.
+
+    python benchmarks/async_chain_benchmark.py --latency 0.2 --requests 200 --clients 1,8,32,128 --workers 4
+"""
+import sys
+import os
+sys.path.append(os.path.abspath('./src'))
+sys.path.append(os.path.abspath('./src/MAGGIE'))
+sys.path.append(os.path.abspath('./tests'))
+import argparse
+import asyncio
+import itertools
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_core.messages import AIMessage
+from fake_databricks import ANSWER, FakeChatModel, FakeEmbeddings, FakeVectorSearch, fake_backend_transport, load_chain_module
+
+
+def make_question(i: int) -> dict:
+    return {"messages": [{"role": "user", "content": f"How do I replace the brake pads of axle {i}?"}]}
+
+
+def run_sync(chain, nr_requests: int, nr_clients: int, nr_workers: int) -> list:
+    # The model server hands each request to a worker thread: clients beyond the workers queue up
+    questions = itertools.count()
+    workers = ThreadPoolExecutor(max_workers=nr_workers)
+
+    def request():
+        start = time.perf_counter()
+        workers.submit(chain.invoke, make_question(next(questions))).result()
+        return time.perf_counter() - start
+
+    def client(nr):
+        return [request() for _ in range(nr)]
+
+    with ThreadPoolExecutor(max_workers=nr_clients) as clients:
+        shares = [nr_requests // nr_clients + (i < nr_requests % nr_clients) for i in range(nr_clients)]
+        latencies = [latency for share in clients.map(client, shares) for latency in share]
+    workers.shutdown()
+    return latencies
+
+
+async def run_async(chain, nr_requests: int, nr_clients: int) -> list:
+    questions = itertools.count()
+    latencies = []
+
+    async def client(nr):
+        for _ in range(nr):
+            start = time.perf_counter()
+            await chain.ainvoke(make_question(next(questions)))
+            latencies.append(time.perf_counter() - start)
+
+    shares = [nr_requests // nr_clients + (i < nr_requests % nr_clients) for i in range(nr_clients)]
+    await asyncio.gather(*[client(share) for share in shares])
+    return latencies
+
+
+def report(path: str, nr_clients: int, latencies: list, elapsed: float) -> None:
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{path:<6} {nr_clients:>8} {len(latencies) / elapsed:>10.1f} {p50 * 1000:>9.0f} {p95 * 1000:>9.0f} {p99 * 1000:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds per backend call")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--clients', type=str, default="1,8,32,128", help="comma-separated numbers of concurrent clients")
+    parser.add_argument('--workers', type=int, default=4, help="worker threads of the synchronous model server")
+    parser.add_argument('--max-concurrent-requests', type=int, default=64)
+    args = parser.parse_args()
+
+    FakeVectorSearch.latency = args.latency
+    model = FakeChatModel(messages=itertools.cycle([AIMessage(content=ANSWER)]), latency=args.latency)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        chain_module = load_chain_module(setattr, directory, {
+            "answer_cache": {"enabled": False},
+            "reference_mode": "lazy", # the fake backend has no page images to serve
+            "async_serving": {"max_concurrent_requests": args.max_concurrent_requests, "max_connections": 2 * args.max_concurrent_requests, "timeout_seconds": 60},
+        }, chat_model=model, embeddings=FakeEmbeddings(size=16, latency=args.latency))
+        os.chdir(cwd)
+    chain_module.async_databricks.transport = fake_backend_transport(args.latency)
+    chain_module.warm_up()
+
+    print(f"{'path':<6} {'clients':>8} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for nr_clients in [int(c) for c in args.clients.split(',')]:
+        start = time.perf_counter()
+        latencies = run_sync(chain_module.chain, args.requests, nr_clients, args.workers)
+        report("sync", nr_clients, latencies, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        latencies = asyncio.run(run_async(chain_module.chain, args.requests, nr_clients))
+        report("async", nr_clients, latencies, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Compares the text extraction engines of `MAGGIE.extraction` on a synthetic PDF corpus generated locally.
+
+For every engine it reports the throughput (pages/sec), the peak RSS of a fresh process running the extraction and
+how close the extracted text is to the text that was written into the PDFs.
+
+    python benchmarks/pdf_engines_benchmark.py --docs 5 --pages 200
+"""
+import sys
+sys.path.append('./src')
+import argparse
+import difflib
+import multiprocessing
+import os
+import random
+import re
+import resource
+import tempfile
+import time
+
+import pymupdf
+from MAGGIE.extraction import PDF_ENGINES
+
+WORDS = (
+    "brake drum shoe lining axle hub bearing wheel nut torque wrench disc caliper pad piston seal "
+    "spring bolt washer grease inspect replace tighten remove install check wear limit trailer suspension"
+).split()
+
+
+def make_corpus(directory: str, nr_docs: int, nr_pages: int, seed: int = 0) -> dict:
+    # Pages mix paragraphs with a small parts table, similar to the BPW workshop manuals
+    rng = random.Random(seed)
+    truth = {}
+    for d in range(nr_docs):
+        doc = pymupdf.open()
+        doc.set_metadata({'title': f'Synthetic manual {d}'})
+        for p in range(nr_pages):
+            page = doc.new_page()
+            paragraphs = [" ".join(rng.choices(WORDS, k=rng.randint(40, 90))) for _ in range(rng.randint(2, 4))]
+            table = [f"{i:>3}  {rng.randint(10000, 99999)}  {' '.join(rng.choices(WORDS, k=3))}" for i in range(rng.randint(3, 8))]
+            text = "\n\n".join(paragraphs + ["\n".join(table)])
+            page.insert_textbox(pymupdf.Rect(50, 50, 545, 800), text, fontsize=9)
+            truth[(d, p)] = text
+        doc.save(os.path.join(directory, f'manual_{d}.pdf'))
+    return truth
+
+
+def normalize(text: str) -> str:
+    return re.sub(r'\s+', ' ', text or '').strip()
+
+
+def run_engine(engine: str, paths: list, queue: multiprocessing.Queue) -> None:
+    # Runs in a fresh process so that ru_maxrss only reflects this engine
+    start = time.perf_counter()
+    pages = {}
+    for d, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            data = f.read()
+        for _, page_number, text in PDF_ENGINES[engine].iter_pages(data):
+            pages[(d, page_number)] = text
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, pages))
+
+
+def text_stats(pages: dict, truth: dict) -> dict:
+    ratios = [difflib.SequenceMatcher(None, normalize(pages.get(k)), normalize(v), autojunk=False).ratio() for k, v in truth.items()]
+    exact = sum(normalize(pages.get(k)) == normalize(v) for k, v in truth.items())
+    return {'exact_pages': exact / len(truth), 'mean_similarity': sum(ratios) / len(ratios), 'min_similarity': min(ratios)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--engines', nargs='+', default=list(PDF_ENGINES))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        truth = make_corpus(directory, args.docs, args.pages)
+        paths = [os.path.join(directory, f'manual_{d}.pdf') for d in range(args.docs)]
+
+        ctx = multiprocessing.get_context('spawn')
+        results = {}
+        for engine in args.engines:
+            queue = ctx.Queue()
+            process = ctx.Process(target=run_engine, args=(engine, paths, queue))
+            process.start()
+            results[engine] = queue.get()
+            process.join()
+
+    print(f"{len(truth)} pages in {args.docs} documents")
+    print(f"{'engine':<10}{'pages/sec':>12}{'peak RSS (MB)':>16}{'exact pages':>14}{'mean sim':>10}{'min sim':>10}")
+    for engine, (elapsed, max_rss, pages) in results.items():
+        stats = text_stats(pages, truth)
+        # ru_maxrss is reported in KB on Linux
+        print(f"{engine:<10}{len(pages) / elapsed:>12.1f}{max_rss / 1024:>16.1f}{stats['exact_pages']:>14.1%}{stats['mean_similarity']:>10.3f}{stats['min_similarity']:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
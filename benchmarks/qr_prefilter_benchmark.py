@@ -0,0 +1,82 @@
+"""
+Compares the full-page QR decoding path with the two-stage prefilter of `MAGGIE.qr_detection` on synthetic pages,
+some of which carry generated QR codes (as embedded images or drawn as vector graphics).
+
+    python benchmarks/qr_prefilter_benchmark.py --pages 60 --qr-ratio 0.2
+"""
+import sys
+sys.path.append('./src')
+import argparse
+import random
+import time
+
+import cv2
+import numpy as np
+import pymupdf
+from MAGGIE.qr_detection import decode_qr_codes, qr_regions
+
+
+def qr_png(text: str, scale: int = 8) -> bytes:
+    code = cv2.QRCodeEncoder.create().encode(text)
+    code = cv2.resize(code, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+    code = cv2.copyMakeBorder(code, 4 * scale, 4 * scale, 4 * scale, 4 * scale, cv2.BORDER_CONSTANT, value=255)
+    return cv2.imencode('.png', code)[1].tobytes()
+
+
+def draw_qr(page: pymupdf.Page, text: str, rect: pymupdf.Rect) -> None:
+    code = cv2.QRCodeEncoder.create().encode(text)
+    module = rect.width / code.shape[1]
+    shape = page.new_shape()
+    for y, x in zip(*np.nonzero(code == 0)):
+        shape.draw_rect(pymupdf.Rect(rect.x0 + x * module, rect.y0 + y * module, rect.x0 + (x + 1) * module, rect.y0 + (y + 1) * module))
+    shape.finish(color=None, fill=(0, 0, 0))
+    shape.commit()
+
+
+def make_document(nr_pages: int, qr_ratio: float, seed: int = 0):
+    rng = random.Random(seed)
+    doc = pymupdf.open()
+    expected = {}
+    for p in range(nr_pages):
+        page = doc.new_page()
+        page.insert_textbox(pymupdf.Rect(50, 50, 545, 500), " ".join(rng.choices(["brake", "axle", "hub", "torque", "bolt"], k=300)), fontsize=9)
+        if rng.random() < qr_ratio:
+            url = f"https://example.com/partlist/{p:05d}"
+            size = rng.uniform(60, 110)
+            x, y = rng.uniform(50, 545 - size), rng.uniform(520, 800 - size)
+            rect = pymupdf.Rect(x, y, x + size, y + size)
+            if rng.random() < 0.5:
+                page.insert_image(rect, stream=qr_png(url))
+            else:
+                draw_qr(page, url, rect)
+            expected[p] = url
+    return doc, expected
+
+
+def run(doc: pymupdf.Document, prefilter: bool):
+    found = {}
+    start = time.perf_counter()
+    for p in range(doc.page_count):
+        for img in qr_regions(doc[p], prefilter=prefilter):
+            found.setdefault(p, set()).update(decode_qr_codes(img))
+    return time.perf_counter() - start, found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=60)
+    parser.add_argument('--qr-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+
+    doc, expected = make_document(args.pages, args.qr_ratio)
+    print(f"{doc.page_count} pages, {len(expected)} with a QR code")
+    print(f"{'path':<12}{'pages/sec':>12}{'recall':>10}{'false positives':>18}")
+    for name, prefilter in [('full page', False), ('prefilter', True)]:
+        elapsed, found = run(doc, prefilter)
+        recall = sum(url in found.get(p, set()) for p, url in expected.items()) / max(len(expected), 1)
+        false_positives = sum(len(urls - {expected.get(p)}) for p, urls in found.items())
+        print(f"{name:<12}{doc.page_count / elapsed:>12.1f}{recall:>10.1%}{false_positives:>18}")
+
+
+if __name__ == '__main__':
+    main()
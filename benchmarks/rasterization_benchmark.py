@@ -0,0 +1,94 @@
+"""
+Compares the memory and throughput of page rasterization for OpenCV: the pixmap -> PIL -> NumPy -> BGR path of
+`preprocessing.render_page_as_image` against `MAGGIE.rendering.PageRasterizer` (RGB and grayscale views, with and
+without buffer reuse), on synthetic A3 catalog pages.
+
+Each method runs in a fresh process; peak RSS growth is measured from the baseline of that process after the
+document has been loaded.
+
+    python benchmarks/rasterization_benchmark.py --pages 10 --dpi 300
+"""
+import sys
+sys.path.append('./src')
+import argparse
+import multiprocessing
+import random
+import resource
+import time
+
+import cv2
+import numpy as np
+import pymupdf
+from PIL import Image
+from MAGGIE.rendering import PageRasterizer
+
+
+def make_document(nr_pages: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    doc = pymupdf.open()
+    for _ in range(nr_pages):
+        page = doc.new_page(width=842, height=1191) # A3
+        for _ in range(40):
+            x, y = rng.uniform(20, 700), rng.uniform(20, 1100)
+            page.draw_rect(pymupdf.Rect(x, y, x + rng.uniform(20, 120), y + rng.uniform(20, 80)), color=(0, 0, 0), fill=(rng.random(), rng.random(), rng.random()))
+        page.insert_textbox(pymupdf.Rect(40, 40, 800, 1150), " ".join(rng.choices(["brake", "axle", "hub", "torque", "bolt"], k=1500)), fontsize=8)
+    return doc.tobytes()
+
+
+def legacy(doc: pymupdf.Document, dpi: int):
+    # Same steps as preprocessing.render_page_as_image(..., as_opencv=True), without re-opening the document
+    for page in doc:
+        pix = page.get_pixmap(dpi=dpi)
+        pil_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        yield cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+
+
+def rasterizer(grayscale: bool, reuse_buffer: bool):
+    def render(doc: pymupdf.Document, dpi: int):
+        r = PageRasterizer(dpi=dpi, grayscale=grayscale, reuse_buffer=reuse_buffer)
+        for page in doc:
+            yield r.render(page)
+    return render
+
+
+METHODS = {
+    'legacy (PIL + cvtColor)': legacy,
+    'view RGB': rasterizer(grayscale=False, reuse_buffer=False),
+    'view RGB, reused buffer': rasterizer(grayscale=False, reuse_buffer=True),
+    'view gray, reused buffer': rasterizer(grayscale=True, reuse_buffer=True),
+}
+
+
+def run(method: str, data: bytes, dpi: int, queue: multiprocessing.Queue) -> None:
+    doc = pymupdf.open(stream=data, filetype='pdf')
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    checksum = 0
+    for img in METHODS[method](doc, dpi):
+        checksum += int(img[::97, ::89].sum())
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--dpi', type=int, default=300)
+    args = parser.parse_args()
+
+    data = make_document(args.pages)
+    ctx = multiprocessing.get_context('spawn')
+    print(f"{args.pages} A3 pages at {args.dpi} DPI")
+    print(f"{'method':<28}{'pages/sec':>12}{'peak RSS growth (MB)':>24}")
+    for method in METHODS:
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(method, data, args.dpi, queue))
+        process.start()
+        elapsed, rss_growth = queue.get()
+        process.join()
+        # ru_maxrss is reported in KB on Linux
+        print(f"{method:<28}{args.pages / elapsed:>12.2f}{rss_growth / 1024:>24.1f}")
+
+
+if __name__ == '__main__':
+    main()
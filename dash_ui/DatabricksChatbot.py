@@ -2,13 +2,14 @@ import dash
 from dash import html, Input, Output, State, dcc, callback, clientside_callback
 import dash_bootstrap_components as dbc
 from databricks.sdk import WorkspaceClient
-from databricks.sdk.service.serving import ChatMessage, ChatMessageRole
+from databricks.sdk.service.serving import ChatMessage, ChatMessageRole, QueryEndpointResponse
 from datetime import datetime
 import json
 from PIL import Image
 import base64
 import io
 import dash_bootstrap_components as dbc
+from concurrent.futures import ThreadPoolExecutor
 
 
 from services import build_string_input
@@ -254,11 +255,18 @@ class DatabricksChatbot:
         ]
         try:
             print('Calling model endpoint...')
-            response = self.w.serving_endpoints.query(
-                name=self.endpoint_name,
-                messages=chat_messages,
-                max_tokens=max_tokens
-            )
+            # Posted as is rather than through `serving_endpoints.query`, which can only nest extra inputs under
+            # `extra_params`: the chain reads `reference_mode` next to `messages` (see its model signature).
+            # References without images: the pages are fetched from the image store once they are shown.
+            response = QueryEndpointResponse.from_dict(self.w.api_client.do(
+                'POST',
+                f'/serving-endpoints/{self.endpoint_name}/invocations',
+                body={
+                    'messages': [message.as_dict() for message in chat_messages],
+                    'max_tokens': max_tokens,
+                    'reference_mode': 'lazy',
+                },
+            ))
             print('Got response from model endpoint', response)
             self.agent_messages.append(json.loads(response.choices[0].message.content))
             message = self.agent_messages[-1]['answer']
@@ -323,8 +331,7 @@ class DatabricksChatbot:
         #         all_messages.append(row_div)
 
         pil_images = []
-        for ref in references:
-            img_data = base64.b64decode(ref['img_base64'])
+        for img_data in self._load_reference_images(references):
             pil_img = Image.open(io.BytesIO(img_data))
             pil_images.append(pil_img)
 
@@ -353,6 +360,16 @@ class DatabricksChatbot:
             ], className="chat-bubble"),
         ], className='chat chat-start assistant-container')
 
+    def _load_reference_images(self, references):
+        # Inline responses carry the images, lazy ones only a reference ID: their pages are fetched now that they are shown
+        def load(ref):
+            if 'img_base64' in ref:
+                return base64.b64decode(ref['img_base64'])
+            return self.service.get_reference_image(ref, resolution='full')
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            return list(executor.map(load, references))
+
     def image_number_gen(self, no):
         return 'item{}'.format(no)
 
@@ -1,10 +1,21 @@
+import io
+import json
 import os
 
+import pymupdf
+import requests
+from PIL import Image
 from databricks import sql
 from databricks.sdk import WorkspaceClient
 from databricks.sdk.config import Config
 from databricks.sdk.credentials_provider import oauth_service_principal
 
+# Page images pre-rendered at ingest time (see MAGGIE.page_images), read through the Files API. The layout of the store
+# is set in the app environment (app.yaml), with the values of MAGGIE.utils the store was rendered with.
+PAGE_IMAGES_PATH = os.environ['PAGE_IMAGES_PATH']
+PAGE_IMAGES_FORMAT = os.environ['PAGE_IMAGES_FORMAT']
+PAGE_IMAGE_RESOLUTIONS = json.loads(os.environ['PAGE_IMAGE_RESOLUTIONS']) # name -> DPI
+
 class DatabricksService:
     def __init__(self):
         self.client = WorkspaceClient(client_id=os.environ['DATABRICKS_CLIENT_ID'], client_secret=os.environ['DATABRICKS_CLIENT_SECRET'], host=os.environ['DATABRICKS_HOST'])
@@ -48,6 +59,28 @@ class DatabricksService:
         return list(map(lambda x: {'label': x[1], 'value': x[1]}, results))
         # return [{'label': 'test', 'value': 1}, {'label': 'test2', 'value': 2}]
 
+    def get_reference_image(self, reference: dict, resolution: str = 'full', image_format: str = 'webp') -> bytes:
+        # `reference` is one of the references of a lazy chain response: its `reference_id` is the key of the page in
+        # the image store ("<document id>:<0-based page number>")
+        doc_id, page_number = reference['reference_id'].split(':')
+        try:
+            data = self.client.files.download(f"{PAGE_IMAGES_PATH}/{doc_id}/{page_number}_{resolution}.{PAGE_IMAGES_FORMAT}").contents.read()
+            if image_format == PAGE_IMAGES_FORMAT:
+                return data
+            img = Image.open(io.BytesIO(data))
+        except Exception as e:
+            # Page not in the store (yet): render it from the published PDF
+            print(f'Page {page_number} of {reference["doc_uri"]} not found in the image store ({e})')
+            response = requests.get(reference['doc_uri'], timeout=60)
+            response.raise_for_status()
+            with pymupdf.open(stream=response.content, filetype='pdf') as doc:
+                pix = doc[int(page_number)].get_pixmap(dpi=PAGE_IMAGE_RESOLUTIONS[resolution])
+                img = Image.frombytes('RGB', [pix.width, pix.height], pix.samples)
+
+        buffer = io.BytesIO()
+        img.convert('RGB').save(buffer, format=image_format.upper())
+        return buffer.getvalue()
+
     def credential_provider(self):
         config = Config(
             host=os.getenv('DATABRICKS_HOST'),
@@ -2,20 +2,25 @@ import os
 import requests
 import collections
 from concurrent.futures import ThreadPoolExecutor
-from .utils import spark
+from .utils import spark, PAGE_IMAGES_FOLDER
 from typing import List
 import pyspark.sql.functions as F
-from .preprocessing import preprocess
+from pyspark.sql import DataFrame
+from .preprocessing import latest_versions, preprocess, upsert_chunks, extract_qr_codes, store_page_images
+from .embedding_cache import EmbeddingCache
 
 class AutoLoader:
-    def __init__(self, catalog: str, schema: str, volume: str, pdfs_folder: str) -> None:
+    def __init__(self, catalog: str, schema: str, volume: str, pdfs_folder: str, embedding_cache_table: str = None) -> None:
         self.volume = f"/Volumes/{catalog}/{schema}/{volume}"
         self.pdfs_path = self.volume + '/' + pdfs_folder.replace('/', '')
         self.checkpoints_path = f'dbfs:{self.volume}/checkpoints'
         self.raw_checkpoints_path = self.checkpoints_path + '/raw_docs'
         self.clean_checkpoints_path = self.checkpoints_path + '/pdf_chunk'
+        self.qr_codes_checkpoints_path = self.checkpoints_path + '/qr_codes'
+        self.page_images_checkpoints_path = self.checkpoints_path + '/page_images'
         spark.sql("CREATE VOLUME IF NOT EXISTS {volume}")
         os.makedirs(self.pdfs_path, exist_ok=True)
+        self.embedding_cache = EmbeddingCache(embedding_cache_table) if embedding_cache_table is not None else None
 
     def _download_pdfs(self, urls: List[str]) -> None:
         def download_file(url):
@@ -49,6 +54,7 @@ class AutoLoader:
             .format('cloudFiles')
             .option('cloudFiles.format', 'BINARYFILE')
             .option("pathGlobFilter", "*.pdf")
+            .option("cloudFiles.allowOverwrites", "true") # pick up manuals re-published under the same file name
             .load('dbfs:'+self.pdfs_path)
             # Write the data as a Delta table
             .writeStream
@@ -58,20 +64,70 @@ class AutoLoader:
             .awaitTermination()
         )
 
+    def _write_clean_batch(self, batch_df: DataFrame, batch_id: int, clean_table_name: str) -> None:
+        # Persist so that the embeddings computed for the upsert are reused to fill the cache
+        rows = preprocess(latest_versions(batch_df), save_table_name=clean_table_name, embedding_cache=self.embedding_cache).persist()
+
+        upsert_chunks(rows, clean_table_name)
+        if self.embedding_cache is not None:
+            self.embedding_cache.update(rows)
+
+        rows.unpersist()
+
     def _write_clean_pdfs(self, raw_table_name: str, clean_table_name: str) -> None:
         (
-            preprocess(spark.readStream.table(raw_table_name), save_table_name=clean_table_name)            
+            spark.readStream.table(raw_table_name)
             .writeStream
+            .foreachBatch(lambda batch_df, batch_id: self._write_clean_batch(batch_df, batch_id, clean_table_name))
             .trigger(availableNow=True)
             .option("checkpointLocation", self.clean_checkpoints_path)
-            .table(clean_table_name)
+            .start()
             .awaitTermination()
         )
+
+        if self.embedding_cache is not None:
+            self.embedding_cache.report()
         
-    def load_pdfs_to_catalog(self, urls: List[str], raw_table_name: str, clean_table_name: str) -> None:
+    def _write_qr_codes(self, raw_table_name: str, qr_codes_table_name: str) -> None:
+        # QR codes are extracted on the executors, only for the files that are new since the last run
+        (
+            spark.readStream.table(raw_table_name)
+            .writeStream
+            .foreachBatch(lambda batch_df, batch_id: extract_qr_codes(latest_versions(batch_df), save_table_name=qr_codes_table_name))
+            .trigger(availableNow=True)
+            .option("checkpointLocation", self.qr_codes_checkpoints_path)
+            .start()
+            .awaitTermination()
+        )
+
+    def _write_page_images(self, raw_table_name: str, page_images_table_name: str, page_images_path: str) -> None:
+        # Pages are pre-rendered once per new or re-published file, so that serving only looks the images up
+        (
+            spark.readStream.table(raw_table_name)
+            .writeStream
+            .foreachBatch(lambda batch_df, batch_id: store_page_images(latest_versions(batch_df), root=page_images_path, save_table_name=page_images_table_name))
+            .trigger(availableNow=True)
+            .option("checkpointLocation", self.page_images_checkpoints_path)
+            .start()
+            .awaitTermination()
+        )
+
+    def load_pdfs_to_catalog(
+        self,
+        urls: List[str],
+        raw_table_name: str,
+        clean_table_name: str,
+        qr_codes_table_name: str = None,
+        page_images_table_name: str = None,
+        page_images_path: str = None,
+    ) -> None:
         self._download_pdfs(urls)
         self._write_raw_pdfs(raw_table_name)
         self._write_clean_pdfs(raw_table_name, clean_table_name)
+        if qr_codes_table_name is not None:
+            self._write_qr_codes(raw_table_name, qr_codes_table_name)
+        if page_images_table_name is not None:
+            self._write_page_images(raw_table_name, page_images_table_name, page_images_path or self.volume + '/' + PAGE_IMAGES_FOLDER)
 
         df = spark.sql("SELECT DISTINCT path FROM .clean_table_name}")
         self.pdfs =  [r.path for r in df.collect()] # save all the paths to pdfs
\ No newline at end of file
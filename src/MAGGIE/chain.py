@@ -1,15 +1,20 @@
+import time
+module_started_at = time.perf_counter()
+
 from langchain_community.embeddings import DatabricksEmbeddings
 from operator import itemgetter
 import mlflow
+from mlflow.entities import SpanType
 import os
 import json
 
 from databricks.vector_search.client import VectorSearchClient
+from databricks.sdk import WorkspaceClient
 
 from langchain_community.chat_models import ChatDatabricks
 from langchain_community.vectorstores import DatabricksVectorSearch
 
-from langchain_core.runnables import RunnableLambda, RunnableParallel, RunnablePassthrough, RunnableBranch
+from langchain_core.runnables import Runnable, RunnableLambda, RunnableParallel, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import (
     PromptTemplate,
@@ -17,57 +22,628 @@ from langchain_core.prompts import (
     MessagesPlaceholder,
 )
 from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.documents import Document
+from langchain_core.pydantic_v1 import create_model
 from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain.agents.react.agent import create_react_agent
 from langchain_community.tools.databricks import UCFunctionToolkit
+from page_store import document_id, page_image_path
 
 from PIL import Image
 import pymupdf
 import base64
+import numpy as np
+import hashlib
+import io
+import math
 import requests
+import httpx
+import asyncio
+from typing import List, Optional
+import weakref
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+# Seconds spent in each step of the cold start, in the order they happened (see `get_startup_timings`)
+startup_timings = OrderedDict(imports=time.perf_counter() - module_started_at)
+
+@contextmanager
+def startup_timer(name: str):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started_at
 
 ## Enable MLflow Tracing
-mlflow.langchain.autolog()
+with startup_timer("tracing"):
+    mlflow.langchain.autolog()
 
 
 
 #### VARIABLES
 
 # Load the chain's configuration
-model_config = mlflow.models.ModelConfig(development_config="rag_chain_config.yaml")
+with startup_timer("config"):
+    model_config = mlflow.models.ModelConfig(development_config="rag_chain_config.yaml")
 
 databricks_resources = model_config.get("databricks_resources")
 retriever_config = model_config.get("retriever_config")
 llm_config = model_config.get("llm_config")
+vector_search_schema = retriever_config.get("schema")
+page_images_config = retriever_config.get("page_images")
+
+
+
+#### RESOURCES
+
+# Client or connection created on first use, so that importing the chain (when logging it, or when a scaled-to-zero
+# endpoint starts) costs no network round trip. Concurrent first uses wait for a single creation, whose duration is
+# added to the startup timings.
+class LazyResource:
+    def __init__(self, name: str, factory) -> None:
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.value is None:
+            with self.lock:
+                if self.value is None:
+                    with startup_timer(self.name):
+                        self.value = self.factory()
+        return self.value
+
+    def is_ready(self) -> bool:
+        return self.value is not None
+
+# Runnable standing for the one a LazyResource creates, for the parts of the chain built at import time. `afunc`, if
+# given, is a native async implementation used by `ainvoke` instead of the resource's own.
+class LazyRunnable(Runnable):
+    def __init__(self, resource: LazyResource, afunc=None) -> None:
+        self.resource = resource
+        self.afunc = afunc
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.resource.get().invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        if self.afunc is not None:
+            return await self.afunc(input)
+        return await self.resource.get().ainvoke(input, config, **kwargs)
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.resource.get().stream(input, config, **kwargs)
+
+    def transform(self, input, config=None, **kwargs):
+        yield from self.resource.get().transform(input, config, **kwargs)
 
 # Connect to the Vector Search Index
-vs_client = VectorSearchClient(disable_notice=True)
-vs_index = vs_client.get_index(
+vs_index = LazyResource("vector_search_index", lambda: VectorSearchClient(disable_notice=True).get_index(
     endpoint_name=databricks_resources.get("vector_search_endpoint_name"),
     index_name=retriever_config.get("vector_search_index"),
-)
-vector_search_schema = retriever_config.get("schema")
+))
 
-embedding_model = DatabricksEmbeddings(endpoint=retriever_config.get("embedding_model"))
+embedding_model = LazyResource("embedding_model", lambda: DatabricksEmbeddings(endpoint=retriever_config.get("embedding_model")))
 
 # Turn the Vector Search index into a LangChain retriever
-vector_search_as_retriever = DatabricksVectorSearch(
-    vs_index,
+vector_search = LazyResource("vector_search", lambda: DatabricksVectorSearch(
+    vs_index.get(),
     text_column=vector_search_schema.get("chunk_text"),
-    embedding=embedding_model, 
+    embedding=embedding_model.get(),
     columns=[
         vector_search_schema.get("primary_key"),
         vector_search_schema.get("chunk_text"),
         vector_search_schema.get("document_uri"),
         vector_search_schema.get("page_nr")
     ],
-).as_retriever(search_kwargs=retriever_config.get("parameters"))
+))
+
+# Model for generation
+chat_model = LazyResource("chat_model", lambda: ChatDatabricks(
+    endpoint=databricks_resources.get("llm_endpoint_name"),
+    extra_params=llm_config.get("llm_parameters"),
+))
+
+# Client for the Files API, through which the pre-rendered page images and the precomputed answers are read from
+# the Unity Catalog volume
+workspace_client = LazyResource("workspace_client", lambda: WorkspaceClient())
+
+# Async counterparts of the calls made through the clients above, straight to the REST APIs of the workspace: the
+# serving endpoints of the LLM and the embeddings, the Vector Search index and the Files API. They serve `ainvoke`,
+# where a replica waits on I/O for many requests at once instead of one per worker thread.
+class AsyncDatabricksClient:
+    def __init__(self, timeout_seconds: float, max_connections: int, transport: httpx.AsyncBaseTransport = None) -> None:
+        self.timeout_seconds = timeout_seconds
+        self.max_connections = max_connections
+        self.transport = transport  # e.g. a fake backend in the tests and the load test
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self) -> httpx.AsyncClient:
+        # A connection pool can only be used from the event loop it was created in
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = httpx.AsyncClient(
+                timeout=self.timeout_seconds,
+                limits=httpx.Limits(max_connections=self.max_connections),
+                transport=self.transport,
+            )
+        return client
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        config = workspace_client.get().config
+        # In a thread: refreshing an expired token is itself a blocking HTTP call
+        headers = await asyncio.to_thread(config.authenticate)
+        response = await self._client().request(method, config.host.rstrip("/") + path, headers=headers, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def chat(self, messages: list, **params) -> str:
+        response = await self._request("POST", f"/serving-endpoints/{databricks_resources.get('llm_endpoint_name')}/invocations", json={"messages": messages, **params})
+        return response.json()["choices"][0]["message"]["content"]
+
+    async def embed(self, texts: list) -> list:
+        response = await self._request("POST", f"/serving-endpoints/{retriever_config.get('embedding_model')}/invocations", json={"input": texts})
+        return [d["embedding"] for d in sorted(response.json()["data"], key=lambda d: d.get("index", 0))]
+
+    async def similarity_search_by_vector(self, query_vector: list, k: int = 4, query_type: str = "ann") -> list:
+        # Same documents as `DatabricksVectorSearch.similarity_search_by_vector`: the text column as content, the
+        # other columns (except the score) as metadata
+        text_column = vector_search_schema.get("chunk_text")
+        columns = [vector_search_schema.get(c) for c in ["primary_key", "chunk_text", "document_uri", "page_nr"]]
+        response = await self._request("POST", f"/api/2.0/vector-search/indexes/{retriever_config.get('vector_search_index')}/query", json={
+            "query_vector": query_vector,
+            "num_results": k,
+            "query_type": query_type.upper(),
+            "columns": columns,
+        })
+        result = response.json()
+        names = [c["name"] for c in result["manifest"]["columns"]]
+        docs = []
+        for row in result.get("result", {}).get("data_array") or []:
+            record = dict(zip(names, row))
+            docs.append(Document(page_content=record.pop(text_column), metadata={name: value for name, value in record.items() if name != "score"}))
+        return docs
+
+    async def download(self, path: str) -> bytes:
+        return (await self._request("GET", f"/api/2.0/fs/files{path}")).content
+
+    async def fetch(self, url: str) -> bytes:
+        # Public URLs, without the workspace credentials
+        response = await self._client().get(url)
+        response.raise_for_status()
+        return response.content
+
+async_serving_config = retriever_config.get("async_serving")
+async_databricks = AsyncDatabricksClient(async_serving_config.get("timeout_seconds"), async_serving_config.get("max_connections"))
+
+# Requests answered concurrently through `ainvoke`, one limit per event loop (asyncio primitives can't be shared
+# between loops). The others wait for a slot.
+request_semaphores = weakref.WeakKeyDictionary()
+
+def get_request_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = request_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = request_semaphores[loop] = asyncio.Semaphore(async_serving_config.get("max_concurrent_requests"))
+    return semaphore
 
 CATALOG_NAME = "`test-catalog`"
 SCHEMA_NAME = "bronze"
 TABLE_PATH = "{}.{}.".format(CATALOG_NAME, SCHEMA_NAME) + "{table_name}"
 
 
+#### TIMINGS
+
+# Counts of durations in buckets growing by 20% from 1 ms: percentiles are estimated within 20%, at a constant memory
+# and recording cost
+class LatencyHistogram:
+    MIN_SECONDS = 0.001
+    GROWTH = 1.2
+
+    def __init__(self) -> None:
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, seconds: float) -> None:
+        bucket = 0 if seconds <= self.MIN_SECONDS else math.ceil(math.log(seconds / self.MIN_SECONDS, self.GROWTH))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.MIN_SECONDS * self.GROWTH ** bucket, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else 0.,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+# Always on: every stage of every request feeds the histogram of the stage. The stages of the current request are
+# also collected in `request_timings`, for the optional `timings` block of the response.
+stage_timings_config = retriever_config.get("stage_timings")
+stage_histograms = {}
+stage_histograms_lock = threading.Lock()
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def record_stage(stage: str, seconds: float) -> None:
+    with stage_histograms_lock:
+        if stage not in stage_histograms:
+            stage_histograms[stage] = LatencyHistogram()
+        stage_histograms[stage].record(seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.) + seconds, 4)
+
+@contextmanager
+def stage_timer(stage: str):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started_at)
+
+def get_stage_timings(reset: bool = False) -> dict:
+    # Percentiles per stage, in seconds, since the start of the replica or the last reset
+    global stage_histograms
+    with stage_histograms_lock:
+        summaries = {stage: histogram.summary() for stage, histogram in stage_histograms.items()}
+        if reset:
+            stage_histograms = {}
+    return summaries
+
+def wants_timings(inputs) -> bool:
+    return stage_timings_config.get("include_in_response") or bool(inputs.get("return_timings"))
+
+def with_timings(response: str, timings: dict) -> str:
+    return json.dumps({**json.loads(response), "timings": timings})
+
+# Runs `runnable` as a stage. With `first_chunk_stage`, a streamed run also records the time to its first chunk; an
+# invoked run has no first chunk, so the stage is left out of its timings rather than recorded as the whole run.
+class TimedRunnable(Runnable):
+    def __init__(self, stage: str, runnable: Runnable, first_chunk_stage: str = None) -> None:
+        self.stage = stage
+        self.runnable = runnable
+        self.first_chunk_stage = first_chunk_stage
+
+    def invoke(self, input, config=None, **kwargs):
+        with stage_timer(self.stage):
+            return self.runnable.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        with stage_timer(self.stage):
+            return await self.runnable.ainvoke(input, config, **kwargs)
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.transform(iter([input]), config, **kwargs)
+
+    def transform(self, input, config=None, **kwargs):
+        started_at = time.perf_counter()
+        is_first = self.first_chunk_stage is not None
+        try:
+            for chunk in self.runnable.transform(input, config, **kwargs):
+                if is_first:
+                    record_stage(self.first_chunk_stage, time.perf_counter() - started_at)
+                    is_first = False
+                yield chunk
+        finally:
+            record_stage(self.stage, time.perf_counter() - started_at)
+
+# Every `dump_interval_seconds`, the percentiles of the interval are appended to the sink as one JSON line per stage.
+# Under /Volumes, each dump is a new file of the folder (the Files API can't append), ready for
+# `COPY INTO` or Auto Loader into a Delta table; elsewhere, lines are appended to `stage_timings.jsonl`.
+replica_id = f"{os.uname().nodename}-{os.getpid()}"
+
+def dump_stage_timings(sink_path: str = None) -> int:
+    sink_path = sink_path or stage_timings_config.get("sink_path")
+    dumped_at = time.time()
+    rows = [{"replica": replica_id, "dumped_at": dumped_at, "stage": stage, **summary} for stage, summary in get_stage_timings(reset=True).items()]
+    if sink_path is None or len(rows) == 0:
+        return 0
+    lines = "".join(json.dumps(row) + "\n" for row in rows)
+    if sink_path.startswith("/Volumes/"):
+        workspace_client.get().files.upload(f"{sink_path}/{replica_id}-{int(dumped_at)}.jsonl", io.BytesIO(lines.encode("utf-8")), overwrite=True)
+    else:
+        os.makedirs(sink_path, exist_ok=True)
+        with open(os.path.join(sink_path, "stage_timings.jsonl"), "a") as f:
+            f.write(lines)
+    return len(rows)
+
+def dump_stage_timings_periodically() -> None:
+    while True:
+        time.sleep(stage_timings_config.get("dump_interval_seconds"))
+        try:
+            dump_stage_timings()
+        except Exception as e:
+            print(f"Exception {e} has been thrown while dumping the stage timings")
+
+def start_stage_timings_sink() -> threading.Thread:
+    if stage_timings_config.get("sink_path") is None or not stage_timings_config.get("dump_interval_seconds"):
+        return None
+    thread = threading.Thread(target=dump_stage_timings_periodically, name="stage_timings_sink", daemon=True)
+    thread.start()
+    return thread
+
+
+
+#### CACHES
+
+# Bounded, thread-safe LRU cache of byte strings, evicted by total size. Concurrent misses for the same key are
+# coalesced: the first caller loads the value while the others wait for its result (single flight).
+class ByteSizeLRUCache:
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader) -> bytes:
+        value, future, is_owner = self._claim(key)
+        if value is not None:
+            return value
+        if not is_owner:
+            return future.result()
+        try:
+            value = loader()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        return self._store(key, future, value)
+
+    async def aget_or_load(self, key, aloader) -> bytes:
+        # Same as `get_or_load` with a coroutine loader, sharing the single flight with the synchronous callers
+        value, future, is_owner = self._claim(key)
+        if value is not None:
+            return value
+        if not is_owner:
+            return await asyncio.wrap_future(future)
+        try:
+            value = await aloader()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        return self._store(key, future, value)
+
+    def _claim(self, key):
+        # Returns the cached value, or the future of the load and whether the caller is the one who must load it
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key], None, False
+            future = self._loading.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._loading[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+            return None, future, is_owner
+
+    def _fail(self, key, future: Future, exception: BaseException) -> None:
+        # Failures are not cached, the next request tries again
+        with self._lock:
+            del self._loading[key]
+        future.set_exception(exception)
+
+    def _store(self, key, future: Future, value: bytes) -> bytes:
+        with self._lock:
+            del self._loading[key]
+            # Values larger than the whole cache are served but not kept
+            if len(value) <= self.max_bytes:
+                self._entries[key] = value
+                self.size += len(value)
+                while self.size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= len(evicted)
+                    self.evictions += 1
+        future.set_result(value)
+        return value
+
+    def stats(self) -> dict:
+        # Coalesced lookups waited for a load already in flight: they didn't load anything but weren't served from
+        # the cache either, so they only count in `coalesced`
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.,
+            }
+
+# Bounded, thread-safe LRU cache whose entries expire `ttl_seconds` after being stored
+class TTLCache:
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.,
+            }
+
+# Answers of previous questions, found again by embedding similarity. An entry only matches questions asked with the
+# same chat history, against the same version of the index, whose embedding has at least `similarity_threshold`
+# cosine similarity with the stored one.
+# Bounded by entries and by bytes: an answer with inline references carries the base64 images of its pages
+class SemanticAnswerCache:
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float, similarity_threshold: float) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict() # (history fingerprint, index version, question) -> (stored at, unit vector, answer)
+        self._lock = threading.Lock()
+
+    def lookup(self, query_vector: list, history_fingerprint: str, version):
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector)
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, (stored_at, _, _) in self._entries.items() if now - stored_at > self.ttl_seconds]:
+                self._remove(key)
+            candidates = [k for k in self._entries if k[0] == history_fingerprint and k[1] == version]
+            if len(candidates) > 0:
+                similarities = np.stack([self._entries[k][1] for k in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self._entries.move_to_end(candidates[best])
+                    self.hits += 1
+                    return self._entries[candidates[best]][2]
+            self.misses += 1
+            return None
+
+    def put(self, question: str, query_vector: list, history_fingerprint: str, version, answer: str) -> None:
+        vector = np.asarray(query_vector, dtype=np.float32)
+        nr_bytes = len(answer.encode("utf-8"))
+        with self._lock:
+            key = (history_fingerprint, version, question)
+            if key in self._entries:
+                self._remove(key)
+            # Answers larger than the whole cache are served but not kept
+            if nr_bytes > self.max_bytes:
+                return
+            self._entries[key] = (time.monotonic(), vector / np.linalg.norm(vector), answer)
+            self.size += nr_bytes
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key) -> None:
+        _, _, answer = self._entries.pop(key)
+        self.size -= len(answer.encode("utf-8"))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.,
+            }
+
+image_cache_config = retriever_config.get("image_cache")
+pdf_cache = ByteSizeLRUCache(max_bytes=image_cache_config.get("max_pdf_mb") * 1024 * 1024)
+page_image_cache = ByteSizeLRUCache(max_bytes=image_cache_config.get("max_page_image_mb") * 1024 * 1024)
+
+query_cache_config = retriever_config.get("query_cache")
+query_embedding_cache = TTLCache(max_entries=query_cache_config.get("max_entries"), ttl_seconds=query_cache_config.get("ttl_seconds"))
+retrieval_cache = TTLCache(max_entries=query_cache_config.get("max_entries"), ttl_seconds=query_cache_config.get("ttl_seconds"))
+
+answer_cache_config = retriever_config.get("answer_cache")
+answer_cache = SemanticAnswerCache(
+    max_entries=answer_cache_config.get("max_entries"),
+    max_bytes=answer_cache_config.get("max_mb") * 1024 * 1024,
+    ttl_seconds=answer_cache_config.get("ttl_seconds"),
+    similarity_threshold=answer_cache_config.get("similarity_threshold"),
+)
+
+# Version of the index content, refreshed at most every `index_version_refresh_seconds`. Retrieved documents and
+# answers are keyed by it, so a sync of the index makes the cached results unreachable.
+index_version = {"version": None, "checked_at": None}
+index_version_lock = threading.Lock()
+
+def get_index_version():
+    with index_version_lock:
+        checked_at = index_version["checked_at"]
+        if checked_at is not None and time.monotonic() - checked_at < query_cache_config.get("index_version_refresh_seconds"):
+            return index_version["version"]
+        try:
+            status = vs_index.get().describe().get("status", {})
+            update_status = status.get("triggered_update_status") or status.get("continuous_update_status") or {}
+            version = update_status.get("last_processed_commit_version", status.get("indexed_row_count"))
+        except Exception as e:
+            print(f"Exception {e} has been thrown while describing the vector search index")
+            version = index_version["version"]
+        if version != index_version["version"]:
+            retrieval_cache.clear()
+            answer_cache.clear()
+        index_version.update(version=version, checked_at=time.monotonic())
+        return version
+
+async def aget_index_version():
+    # The describe call, when due, runs in a thread: the event loop never waits on it, nor on the lock held around it
+    if index_version_lock.acquire(blocking=False):
+        try:
+            checked_at, version = index_version["checked_at"], index_version["version"]
+        finally:
+            index_version_lock.release()
+        if checked_at is not None and time.monotonic() - checked_at < query_cache_config.get("index_version_refresh_seconds"):
+            return version
+    return await asyncio.to_thread(get_index_version)
+
+
 
 #### METHODS
 
@@ -114,35 +690,226 @@ def format_context(docs):
     ]
     return "".join(chunk_contents)
 
-def get_page_image_bytes(url: str, page_number: int) -> str:
-    pdf_path = './doc.pdf'
+# Tokenizer for the context budget. `encoding` is a tiktoken encoding, not the one of the served LLM but within a few
+# percent of it on English text. Without it (tiktoken missing, or its encoding file can't be downloaded), the length
+# is estimated at ~4 characters per token.
+class Tokenizer:
+    def __init__(self, encoding=None) -> None:
+        self.encoding = encoding
+
+    def count(self, text: str) -> int:
+        if self.encoding is None:
+            return len(text) // 4 + 1
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if self.encoding is None:
+            return text[:max_tokens * 4]
+        return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def load_tokenizer() -> Tokenizer:
+    try:
+        import tiktoken
+        return Tokenizer(tiktoken.get_encoding(context_config.get("encoding")))
+    except Exception as e:
+        print(f"Exception {e} has been thrown while loading the tokenizer, estimating the tokens from the characters")
+        return Tokenizer()
+
+context_config = retriever_config.get("context")
+tokenizer = LazyResource("tokenizer", load_tokenizer)
+
+# Constant of reciprocal rank fusion: the usual value, which keeps the ranks of the first results close to each other
+RRF_K = 60
+
+def rank_chunks(retrievals: list) -> list:
+    # One document per primary key, ordered by reciprocal rank fusion over the retrievals: a chunk ranked high, or
+    # retrieved by several of the queries, comes first. Ties keep the order of the retrievals (main, parts, tools).
+    primary_key = vector_search_schema.get("primary_key")
+    scores, chunks = {}, {}
+    for docs in retrievals:
+        for rank, doc in enumerate(docs):
+            key = doc.metadata.get(primary_key, doc.page_content)
+            scores[key] = scores.get(key, 0.) + 1. / (RRF_K + rank + 1)
+            chunks.setdefault(key, doc)
+    return [chunks[key] for key in sorted(chunks, key=lambda key: -scores[key])]
+
+def jaccard_similarity(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if len(a | b) > 0 else 1.
+
+def pack_context(retrievals: list) -> str:
+    # The retrieved chunks, without duplicates (same primary key, or near-identical words), most relevant first, up
+    # to `max_tokens`. Chunks that don't fit are skipped, smaller ones further down may still fit; a first chunk
+    # larger than the whole budget is truncated rather than leaving the context empty.
+    budget = context_config.get("max_tokens")
+    threshold = context_config.get("near_duplicate_threshold")
+    packed, packed_words, used = [], [], 0
+    with stage_timer("context_packing"):
+        for doc in rank_chunks(retrievals):
+            words = set(normalize_query(doc.page_content).split())
+            if any(jaccard_similarity(words, other) >= threshold for other in packed_words):
+                continue
+            text = format_context([doc])
+            tokens = tokenizer.get().count(text)
+            if used + tokens > budget:
+                if len(packed) == 0:
+                    packed.append(tokenizer.get().truncate(text, budget))
+                    packed_words.append(words)
+                    used = budget
+                continue
+            packed.append(text)
+            packed_words.append(words)
+            used += tokens
+    return "".join(packed)
+
+def download_pdf(url: str) -> bytes:
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    return response.content
+
+def render_page_image(pdf: bytes, page_number: int) -> bytes:
+    # The PDF is opened from memory: concurrent requests never share a file on disk
+    with pymupdf.open(stream=pdf, filetype="pdf") as doc:
+        pix = doc[page_number].get_pixmap(dpi=300)
+        return pix.tobytes("png")  # Convert to PNG bytes
+
+def get_page_image_bytes(url: str, page_number: int) -> bytes:
+    pdf = pdf_cache.get_or_load(url, lambda: download_pdf(url))
+    return render_page_image(pdf, page_number)
+
+async def aget_page_image_bytes(url: str, page_number: int) -> bytes:
+    pdf = await pdf_cache.aget_or_load(url, lambda: async_databricks.fetch(url))
+    return await asyncio.to_thread(render_page_image, pdf, page_number)
+
+# Stable across requests and replicas: "<document id>:<0-based page number>", the key of the page in the image store
+def reference_id(path: str, page_number: int) -> str:
+    return f"{document_id(path)}:{page_number}"
+
+def get_stored_page_image(path: str, page_number: int) -> bytes:
+    if page_images_config is None:
+        return None
+    try:
+        image_path = page_image_path(page_images_config.get("root"), path, page_number, page_images_config.get("resolution"), page_images_config.get("format"))
+        return workspace_client.get().files.download(image_path).contents.read()
+    except Exception as e:
+        print(f"Page {page_number} of {path} not found in the image store ({e}), rendering it from the source PDF")
+        return None
+
+async def aget_stored_page_image(path: str, page_number: int) -> bytes:
+    if page_images_config is None:
+        return None
+    try:
+        image_path = page_image_path(page_images_config.get("root"), path, page_number, page_images_config.get("resolution"), page_images_config.get("format"))
+        return await async_databricks.download(image_path)
+    except Exception as e:
+        print(f"Page {page_number} of {path} not found in the image store ({e}), rendering it from the source PDF")
+        return None
+
+def load_page_image(url: str, page_number: int, pdf_path: str) -> bytes:
+    # A key lookup in the store built at ingest time, the download and rasterization only happen for missing pages
+    img = get_stored_page_image(pdf_path, page_number)
+    if img is None:
+        img = get_page_image_bytes(url, page_number)
+    return img
+
+async def aload_page_image(url: str, page_number: int, pdf_path: str) -> bytes:
+    img = await aget_stored_page_image(pdf_path, page_number)
+    if img is None:
+        img = await aget_page_image_bytes(url, page_number)
+    return img
+
+def get_reference_image(url: str, page_number: int, pdf_path: str) -> str:
+    try:
+        img = page_image_cache.get_or_load((pdf_path, page_number), lambda: load_page_image(url, page_number, pdf_path))
+    except Exception as e:
+        print(f"Exception {e} has been thrown while loading page {page_number} of {url}")
+        return ""
+    return base64.b64encode(img).decode()  # Convert to base64 and decode to string
+
+async def aget_reference_image(url: str, page_number: int, pdf_path: str) -> str:
     try:
-        pdf = requests.get(url)
-    except:
+        img = await page_image_cache.aget_or_load((pdf_path, page_number), lambda: aload_page_image(url, page_number, pdf_path))
+    except Exception as e:
+        print(f"Exception {e} has been thrown while loading page {page_number} of {url}")
         return ""
-    with open(pdf_path, 'wb') as f:
-        f.write(pdf.content)
-    doc = pymupdf.open(pdf_path)
-    page = doc[page_number]
-    pix = page.get_pixmap(dpi=300)
-    # return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-    img = pix.tobytes("png")  # Convert to PNG bytes
-    img_str = base64.b64encode(img).decode()  # Convert to base64 and decode to string
-    os.remove(pdf_path)
-    return img_str
+    return base64.b64encode(img).decode()
+
+def get_cache_stats() -> dict:
+    return {
+        "pdfs": pdf_cache.stats(),
+        "page_images": page_image_cache.stats(),
+        "query_embeddings": query_embedding_cache.stats(),
+        "retrievals": retrieval_cache.stats(),
+        "answers": answer_cache.stats(),
+    }
 
-def combine_references(outputs):
-    refs = set()
+def make_placeholder_image(text: str = "Preview not available yet") -> str:
+    doc = pymupdf.open()
+    page = doc.new_page(width=420, height=595)
+    page.insert_textbox(pymupdf.Rect(40, 270, 380, 330), text, fontsize=18, align=pymupdf.TEXT_ALIGN_CENTER)
+    return base64.b64encode(page.get_pixmap(dpi=72).tobytes("png")).decode()
+
+# Shared by all the requests of the replica, so that the total number of concurrent renders stays bounded.
+# Pages that miss a request's budget keep rendering in the background and land in the cache for the next request.
+reference_images_config = retriever_config.get("reference_images")
+reference_image_executor = ThreadPoolExecutor(max_workers=reference_images_config.get("max_workers"))
+placeholder_image = make_placeholder_image()
+
+def group_references(outputs) -> dict:
+    # One reference per (document, page): chunks of the same page share its image, their contents are joined
+    refs = {}
     for var, output in outputs.items():
         if 'references' in var:
             for ref in output:
-                refs.add((ref.metadata['id'], ref.page_content, retriever_config.get("uri_prefix") + ref.metadata['url'].split('/')[-1], ref.metadata['page_number'], ref.metadata['url'].replace("dbfs:", "")))
+                pdf_path = ref.metadata['url'].replace("dbfs:", "")
+                page_nr = int(ref.metadata['page_number'])
+                url = retriever_config.get("uri_prefix") + ref.metadata['url'].split('/')[-1]
+                entry = refs.setdefault((pdf_path, page_nr), {"url": url, "contents": []})
+                if ref.page_content not in entry["contents"]:
+                    entry["contents"].append(ref.page_content)
+    return refs
+
+def lazy_references(refs: dict) -> list:
+    # No images in the response: clients fetch the ones they display by reference ID, at the resolution they need
+    return [
+        dict(zip(["reference_id", "content", "doc_uri", "page_number"], [reference_id(pdf_path, page_nr), "\n".join(ref["contents"]), ref["url"], page_nr+1]))
+        for (pdf_path, page_nr), ref in refs.items()
+    ]
+
+def inline_references(refs: dict, images: dict) -> list:
+    return [
+        dict(zip(["content", "doc_uri", "page_number", "img_base64"], ["\n".join(ref["contents"]), ref["url"], page_nr+1, images.get((pdf_path, page_nr)) or placeholder_image]))
+        for (pdf_path, page_nr), ref in refs.items()
+    ]
+
+def combine_references(outputs):
+    with stage_timer("references"):
+        return combine_reference_images(outputs)
 
-    references = []
-    for _, content, url, page_nr, pdf_path in refs:
-        references.append(dict(zip(["content", "doc_uri", "page_number", "img_base64"], [content, url, int(page_nr)+1, get_page_image_bytes(url, int(page_nr))])))
+async def acombine_references(outputs):
+    with stage_timer("references"):
+        return await acombine_reference_images(outputs)
 
-    return references
+def reference_mode(inputs) -> str:
+    return inputs.get("reference_mode") or retriever_config.get("reference_mode")
+
+def combine_reference_images(outputs):
+    refs = group_references(outputs)
+    if outputs["reference_mode"] == "lazy":
+        return lazy_references(refs)
+
+    futures = {key: reference_image_executor.submit(get_reference_image, ref["url"], key[1], key[0]) for key, ref in refs.items()}
+    wait(futures.values(), timeout=reference_images_config.get("time_budget_seconds"))
+    return inline_references(refs, {key: future.result() for key, future in futures.items() if future.done()})
+
+async def acombine_reference_images(outputs):
+    refs = group_references(outputs)
+    if outputs["reference_mode"] == "lazy" or len(refs) == 0:
+        return lazy_references(refs)
+
+    # Pages that miss the budget keep loading in the background, as long as the event loop runs
+    tasks = {key: asyncio.ensure_future(aget_reference_image(ref["url"], key[1], key[0])) for key, ref in refs.items()}
+    await asyncio.wait(tasks.values(), timeout=reference_images_config.get("time_budget_seconds"))
+    return inline_references(refs, {key: task.result() for key, task in tasks.items() if task.done()})
 
 
 def get_tools(wh_id, catalog='`dev-gold`', schema="maggie_hackathon"):
@@ -213,11 +980,14 @@ output_rewrite_prompt_sequential = PromptTemplate(
 
 #### CHAIN
 
-# Model for generation
-model = ChatDatabricks(
-    endpoint=databricks_resources.get("llm_endpoint_name"),
-    extra_params=llm_config.get("llm_parameters"),
-)
+MESSAGE_ROLES = {"system": "system", "human": "user", "ai": "assistant"}
+
+@mlflow.trace(span_type=SpanType.CHAT_MODEL)
+async def ainvoke_chat_model(prompt) -> AIMessage:
+    messages = [{"role": MESSAGE_ROLES[m.type], "content": m.content} for m in prompt.to_messages()]
+    return AIMessage(content=await async_databricks.chat(messages, **llm_config.get("llm_parameters")))
+
+model = LazyRunnable(chat_model, afunc=ainvoke_chat_model)
 
 model_parser = model | StrOutputParser()
 
@@ -242,14 +1012,6 @@ input_parser = RunnablePassthrough.assign(
     formatted_chat_history=itemgetter("messages") | RunnableLambda(format_chat_history_for_prompt),
 )
 
-vector_store_chain = RunnableBranch(
-    ( #if there is a chat history, then re-write the question 
-        lambda x: len(x["chat_history"]) > 0,
-        query_rewrite_prompt | model_parser, 
-    ), # else return the question as-is
-    itemgetter("question"),
-) | vector_search_as_retriever
-
 
 prompt_inputs = (
     {
@@ -293,7 +1055,7 @@ all_prompt_inputs = (
         "question": lambda x: x["tools_question"],
         "chat_history": lambda x: x["chat_history"],
         "formatted_chat_history": lambda x: x["formatted_chat_history"],
-        "context": lambda x: "\n".join([format_context(x["main_references"]), format_context(x["parts_references"]), format_context(x["tools_references"])]),
+        "context": lambda x: pack_context([x["main_references"], x["parts_references"], x["tools_references"]]),
     }
 )
 
@@ -301,8 +1063,115 @@ update_chat_history_passthrough = RunnablePassthrough.assign(chat_history=Runnab
 
 
 # Additional question to make the LLM list out parts
-parts_listing_question = RunnableLambda(lambda x: "\n".join([x["question"], "What compatible parts or components are needed?"]))
-tools_listing_question = RunnableLambda(lambda x: "\n".join([x["question"], "What tools must be used?"]))
+PARTS_LISTING_QUESTION = "What compatible parts or components are needed?"
+TOOLS_LISTING_QUESTION = "What tools must be used?"
+parts_listing_question = RunnableLambda(lambda x: "\n".join([x["question"], PARTS_LISTING_QUESTION]))
+tools_listing_question = RunnableLambda(lambda x: "\n".join([x["question"], TOOLS_LISTING_QUESTION]))
+
+
+# Multi-query retrieval: the question is rewritten once, the main/parts/tools queries derived from it are embedded
+# in a single request and searched concurrently (the index takes one query vector per call). The pool is shared by
+# the requests of the replica: sized for 3 searches of each concurrent request, so that they don't queue behind the
+# searches of the others.
+retrieval_config = retriever_config.get("retrieval")
+retrieval_executor = ThreadPoolExecutor(max_workers=3 * retrieval_config.get("max_concurrent_requests"))
+
+def rewrite_question(inputs) -> str:
+    if len(inputs["chat_history"]) > 0:
+        with stage_timer("query_rewrite"):
+            return (query_rewrite_prompt | model_parser).invoke(inputs)
+    return inputs["question"]
+
+async def arewrite_question(inputs) -> str:
+    if len(inputs["chat_history"]) > 0:
+        with stage_timer("query_rewrite"):
+            return await (query_rewrite_prompt | model_parser).ainvoke(inputs)
+    return inputs["question"]
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).lower()
+
+def query_texts(queries: list) -> dict:
+    # The normalized query is only the cache key: the endpoint embeds the text of the first query with that key
+    texts = {}
+    for query in queries:
+        texts.setdefault(normalize_query(query), query)
+    return texts
+
+def embed_queries(queries: list) -> list:
+    # Only the queries never seen (or expired) are sent to the endpoint, still in a single request
+    texts = query_texts(queries)
+    vectors = {k: query_embedding_cache.get(k) for k in texts}
+    missing = [k for k, v in vectors.items() if v is None]
+    if len(missing) > 0:
+        for k, v in zip(missing, embedding_model.get().embed_documents([texts[k] for k in missing])):
+            query_embedding_cache.put(k, v)
+            vectors[k] = v
+    return [vectors[normalize_query(q)] for q in queries]
+
+async def aembed_queries(queries: list) -> list:
+    texts = query_texts(queries)
+    vectors = {k: query_embedding_cache.get(k) for k in texts}
+    missing = [k for k, v in vectors.items() if v is None]
+    if len(missing) > 0:
+        for k, v in zip(missing, await async_databricks.embed([texts[k] for k in missing])):
+            query_embedding_cache.put(k, v)
+            vectors[k] = v
+    return [vectors[normalize_query(q)] for q in queries]
+
+def retrieval_cache_key(query_vector, version) -> tuple:
+    parameters = retriever_config.get("parameters")
+    vector_fingerprint = hashlib.sha256(json.dumps(query_vector).encode("utf-8")).hexdigest()
+    return (vector_fingerprint, parameters.get("k"), parameters.get("query_type"), version)
+
+@mlflow.trace(span_type=SpanType.RETRIEVER)
+def search_by_vector(query_vector):
+    key = retrieval_cache_key(query_vector, get_index_version())
+    docs = retrieval_cache.get(key)
+    if docs is None:
+        docs = vector_search.get().similarity_search_by_vector(query_vector, **retriever_config.get("parameters"))
+        retrieval_cache.put(key, docs)
+    return docs
+
+@mlflow.trace(span_type=SpanType.RETRIEVER)
+async def asearch_by_vector(query_vector):
+    key = retrieval_cache_key(query_vector, await aget_index_version())
+    docs = retrieval_cache.get(key)
+    if docs is None:
+        docs = await async_databricks.similarity_search_by_vector(query_vector, **retriever_config.get("parameters"))
+        retrieval_cache.put(key, docs)
+    return docs
+
+def retrieval_queries(question: str) -> dict:
+    return {
+        "main": question,
+        "parts": "\n".join([question, PARTS_LISTING_QUESTION]),
+        "tools": "\n".join([question, TOOLS_LISTING_QUESTION]),
+    }
+
+def timed_search_by_vector(name: str, query_vector):
+    with stage_timer(f"retrieval_{name}"):
+        return search_by_vector(query_vector)
+
+async def atimed_search_by_vector(name: str, query_vector):
+    with stage_timer(f"retrieval_{name}"):
+        return await asearch_by_vector(query_vector)
+
+def retrieve_references(inputs) -> dict:
+    queries = retrieval_queries(rewrite_question(inputs))
+    with stage_timer("embedding"):
+        query_vectors = embed_queries(list(queries.values()))
+    # Each retrieval runs in the context of the request, so that its timing lands in the request's timings
+    futures = {name: retrieval_executor.submit(contextvars.copy_context().run, timed_search_by_vector, name, v) for name, v in zip(queries, query_vectors)}
+    return {name: future.result() for name, future in futures.items()}
+
+async def aretrieve_references(inputs) -> dict:
+    queries = retrieval_queries(await arewrite_question(inputs))
+    with stage_timer("embedding"):
+        query_vectors = await aembed_queries(list(queries.values()))
+    return dict(zip(queries, await asyncio.gather(*[atimed_search_by_vector(name, v) for name, v in zip(queries, query_vectors)])))
+
+multi_query_retriever = RunnableLambda(retrieve_references, afunc=aretrieve_references)
 
 
 # chain = (
@@ -332,18 +1201,31 @@ tools_listing_question = RunnableLambda(lambda x: "\n".join([x["question"], "Wha
 #     # | RunnablePassthrough()
 # )
 
-chain = (
-    input_parser
+# Everything the answer and the references need, up to and including retrieval
+retrieval_chain = (
+    TimedRunnable("input_parsing", input_parser)
+    | RunnablePassthrough.assign(references=multi_query_retriever)
     | {
         "main_question": itemgetter("question"),
         "parts_question": parts_listing_question,
         "tools_question": tools_listing_question,
-        "main_references": {"question": itemgetter("question"), "chat_history": itemgetter("chat_history")} | vector_store_chain,
-        "parts_references": {"question": parts_listing_question, "chat_history": itemgetter("chat_history")} | vector_store_chain,
-        "tools_references": {"question": tools_listing_question, "chat_history": itemgetter("chat_history")} | vector_store_chain,
+        "main_references": lambda x: x["references"]["main"],
+        "parts_references": lambda x: x["references"]["parts"],
+        "tools_references": lambda x: x["references"]["tools"],
         "chat_history": itemgetter("chat_history"),
         "formatted_chat_history": itemgetter("formatted_chat_history"),
+        "reference_mode": reference_mode,
     }
+    | RunnablePassthrough.assign(question=itemgetter("main_question"))
+)
+
+answer_chain = (
+    TimedRunnable("prompt_assembly", all_prompt_inputs | full_prompt_and_rewrite)
+    | TimedRunnable("llm", model_parser, first_chunk_stage="llm_first_token")
+)
+
+rag_chain = (
+    retrieval_chain
     # | RunnablePassthrough.assign(
     #     main_answer=main_prompt_inputs | full_prompt | model_parser, 
     #     parts_answer=parts_prompt_inputs | full_prompt | model_parser,
@@ -356,21 +1238,219 @@ chain = (
     # .assign(question=tools_listing_question, answer=itemgetter("tools_answer")) 
     # | update_chat_history_passthrough # update chat history
     # .assign(answer=output_rewrite_prompt_sequential | model_parser)
-    | RunnablePassthrough.assign(
-        question=itemgetter("main_question"),
-        answer=all_prompt_inputs | full_prompt_and_rewrite | model_parser,
+    # The references only depend on retrieval: they are looked up (or rendered) while the LLM generates the answer
+    | RunnableParallel(
+        answer=answer_chain,
+        references=RunnableLambda(combine_references, afunc=acombine_references),
     )
-    | {
-        "answer": itemgetter("answer"),
-        "references": lambda x: combine_references(x),
-    }
-    | RunnableLambda(lambda x: dict((k, x[k]) for k in ["answer", "references"]))
     | RunnableLambda(lambda x: json.dumps(x))
     # | RunnableLambda(agent_executor_wrapper)  # Pass the query to the agent executor
     # | RunnablePassthrough()
 )
 
 
+def history_fingerprint(inputs) -> str:
+    # Cached answers are only shared between requests with the same chat history that ask for the same kind of references
+    history = [(m["role"], " ".join(m["content"].split())) for m in extract_chat_history(inputs["messages"])]
+    return hashlib.sha256(json.dumps([reference_mode(inputs), history]).encode("utf-8")).hexdigest()
+
+# Answers precomputed offline for the prompts of the Dash UI dropdowns (see MAGGIE.precompute), keyed by the
+# fingerprint of the normalized prompt. The snapshot is reloaded when it doesn't match the current index version, and
+# only serves the requests asking for the kind of references it was computed with.
+precomputed_answers_config = retriever_config.get("precomputed_answers")
+precomputed_answers = {"index_version": None, "reference_mode": None, "answers": {}, "loaded_at": None}
+precomputed_answers_lock = threading.Lock()
+
+def load_precomputed_answers(snapshot: dict) -> dict:
+    try:
+        return {**snapshot, **json.loads(workspace_client.get().files.download(precomputed_answers_config.get("path")).contents.read()), "loaded_at": time.monotonic()}
+    except Exception as e:
+        print(f"Exception {e} has been thrown while loading the precomputed answers")
+        return {**snapshot, "loaded_at": time.monotonic()}
+
+def get_precomputed_answer(question: str, version, mode: str) -> str:
+    global precomputed_answers
+    if version is None:
+        # The index version couldn't be read: no snapshot can be told to match it
+        return None
+    with precomputed_answers_lock:
+        snapshot = precomputed_answers
+        is_stale = snapshot["index_version"] != str(version)
+        is_due = snapshot["loaded_at"] is None or (is_stale and time.monotonic() - snapshot["loaded_at"] > precomputed_answers_config.get("refresh_seconds"))
+        if is_due:
+            # Claims the reload: the other requests keep serving the current snapshot until the new one is swapped in
+            precomputed_answers = {**snapshot, "loaded_at": time.monotonic()}
+    if is_due:
+        # Downloaded outside of the lock, then swapped in whole: a request sees either snapshot, never a mix of both
+        snapshot = load_precomputed_answers(snapshot)
+        precomputed_answers = snapshot
+    if snapshot["index_version"] != str(version) or snapshot["reference_mode"] != mode:
+        return None
+    return snapshot["answers"].get(hashlib.sha256(normalize_query(question).encode("utf-8")).hexdigest())
+
+def find_cached_answer(inputs):
+    # Returns the cached answer, if any, and the entry under which a new answer should be stored in the answer cache
+    if not answer_cache_config.get("enabled") or inputs.get("bypass_cache"):
+        return None, None
+    question = extract_question(inputs["messages"])
+    version = get_index_version()
+    if len(extract_chat_history(inputs["messages"])) == 0:
+        answer = get_precomputed_answer(question, version, reference_mode(inputs))
+        if answer is not None:
+            return answer, None
+
+    # Paraphrases of a question already answered with the same history skip retrieval and the LLM altogether
+    query_vector = embed_queries([question])[0]
+    fingerprint = history_fingerprint(inputs)
+    return answer_cache.lookup(query_vector, fingerprint, version), (question, query_vector, fingerprint, version)
+
+async def afind_cached_answer(inputs):
+    if not answer_cache_config.get("enabled") or inputs.get("bypass_cache"):
+        return None, None
+    question = extract_question(inputs["messages"])
+    version = await aget_index_version()
+    if len(extract_chat_history(inputs["messages"])) == 0:
+        # In a thread: the snapshot may be reloaded through the Files API
+        answer = await asyncio.to_thread(get_precomputed_answer, question, version, reference_mode(inputs))
+        if answer is not None:
+            return answer, None
+
+    query_vector = (await aembed_queries([question]))[0]
+    fingerprint = history_fingerprint(inputs)
+    return answer_cache.lookup(query_vector, fingerprint, version), (question, query_vector, fingerprint, version)
+
+def cache_answer(cache_entry, answer: str) -> None:
+    # Answers with a placeholder for an image that missed the time budget aren't cached: the next paraphrase would
+    # get the placeholder too, even once the page is rendered
+    if cache_entry is None:
+        return
+    if any(ref.get("img_base64") == placeholder_image for ref in json.loads(answer)["references"]):
+        return
+    answer_cache.put(*cache_entry, answer)
+
+def answer_with_cache(inputs, config):
+    timings = {}
+    request_timings.set(timings)
+    with stage_timer("total"):
+        with stage_timer("answer_cache_lookup"):
+            answer, cache_entry = find_cached_answer(inputs)
+        if answer is None:
+            answer = rag_chain.invoke(inputs, config)
+            cache_answer(cache_entry, answer)
+    return with_timings(answer, timings) if wants_timings(inputs) else answer
+
+async def aanswer_with_cache(inputs, config):
+    timings = {}
+    request_timings.set(timings)
+    with stage_timer("total"):
+        async with get_request_semaphore():
+            with stage_timer("answer_cache_lookup"):
+                answer, cache_entry = await afind_cached_answer(inputs)
+            if answer is None:
+                answer = await rag_chain.ainvoke(inputs, config)
+                cache_answer(cache_entry, answer)
+    return with_timings(answer, timings) if wants_timings(inputs) else answer
+
+def answer_event(event_type: str, **kwargs) -> str:
+    return json.dumps({"type": event_type, **kwargs}) + "\n"
+
+# Runs `combine_references` next to the streamed generation. Separate from `reference_image_executor`, whose workers
+# `combine_references` itself waits on.
+references_executor = ThreadPoolExecutor(max_workers=reference_images_config.get("max_workers"))
+
+def stream_answer_events(inputs_iterator, config):
+    # Newline-delimited JSON events: the answer tokens as the LLM generates them, then a single references event
+    # (and, when asked for, a timings event)
+    for inputs in inputs_iterator:
+        timings = {}
+        request_timings.set(timings)
+        started_at = time.perf_counter()
+        with stage_timer("answer_cache_lookup"):
+            answer, cache_entry = find_cached_answer(inputs)
+        if answer is not None:
+            answer = json.loads(answer)
+            yield answer_event("token", content=answer["answer"])
+            yield answer_event("references", references=answer["references"])
+        else:
+            state = retrieval_chain.invoke(inputs, config)
+            references_future = references_executor.submit(contextvars.copy_context().run, combine_references, state)
+            tokens = []
+            for token in answer_chain.stream(state, config):
+                tokens.append(token)
+                yield answer_event("token", content=token)
+            references = references_future.result()
+            yield answer_event("references", references=references)
+
+            cache_answer(cache_entry, json.dumps({"answer": "".join(tokens), "references": references}))
+
+        record_stage("total", time.perf_counter() - started_at)
+        if wants_timings(inputs):
+            yield answer_event("timings", timings=timings)
+
+# `invoke` (predict) returns the answer and the references as one JSON document, `stream` (predict_stream) yields
+# them as events so that the first tokens reach the mechanic while the rest is still being generated. `ainvoke`
+# returns the same document as `invoke`, with every network call made asynchronously.
+# A RunnableLambda, so that MLflow accepts it as a LangChain model.
+class AnswerChain(RunnableLambda):
+    def get_input_schema(self, config=None):
+        # Declares `messages`, so that MLflow passes the request on as is instead of converting it to LangChain
+        # messages, and the optional inputs of the model signature (see `deployment.OPTIONAL_CHAIN_INPUTS`)
+        return create_model(
+            self.get_name("Input"),
+            messages=(List[dict], ...),
+            reference_mode=(Optional[str], None),
+            return_timings=(Optional[bool], None),
+            bypass_cache=(Optional[bool], None),
+        )
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self._transform_stream_with_config(iter([input]), stream_answer_events, config, **kwargs)
+
+chain = AnswerChain(answer_with_cache, afunc=aanswer_with_cache)
+
+
+
+#### WARM UP
+
+WARM_UP_QUESTION = "How do I replace the brake pads?"
+
+def get_startup_timings() -> dict:
+    return dict(startup_timings)
+
+def warm_up(run_query: bool = False) -> dict:
+    # Opens, in parallel, every connection the first request needs. With `run_query`, a synthetic question is also
+    # answered end to end, which wakes up the model serving endpoints behind the LLM and the embeddings.
+    def create(resource):
+        try:
+            resource.get()
+        except Exception as e:
+            print(f"Exception {e} has been thrown while creating {resource.name}")
+
+    with startup_timer("warm_up"):
+        resources = [vs_index, embedding_model, vector_search, chat_model, workspace_client, tokenizer]
+        with ThreadPoolExecutor(max_workers=len(resources)) as executor:
+            list(executor.map(create, resources))
+        get_precomputed_answer("", get_index_version(), retriever_config.get("reference_mode"))
+        if run_query:
+            try:
+                with startup_timer("warm_up_query"):
+                    chain.invoke({"messages": [{"role": "user", "content": WARM_UP_QUESTION}], "bypass_cache": True})
+            except Exception as e:
+                print(f"Exception {e} has been thrown while answering the warm up question")
+    print(f"Chain startup timings (seconds): {json.dumps(get_startup_timings())}")
+    return get_startup_timings()
+
+# Set on the serving endpoint (see `utils.SERVING_ENVIRONMENT_VARS`): "off", "connections" or "query". The warm up runs
+# in the background, so the endpoint is ready as early as before and the first request waits only for what is missing.
+warm_up_mode = os.environ.get("MAGGIE_WARM_UP", "off")
+if warm_up_mode != "off":
+    threading.Thread(target=warm_up, kwargs=dict(run_query=warm_up_mode == "query"), daemon=True).start()
+
+# Also only set on the serving endpoint: logging the model or importing the chain in a notebook or a test dumps nothing
+if os.environ.get("MAGGIE_STAGE_TIMINGS_SINK", "off") == "on":
+    start_stage_timings_sink()
+
+
 #### MLFLOW SETTINGS
 
 # Enable the RAG Studio Review App to properly display retrieved chunks and evaluation suite to measure the retriever
@@ -1,11 +1,21 @@
 import mlflow
 from mlflow.models import ModelConfig, ModelSignature, infer_signature
+from mlflow.types.schema import ColSpec, DataType, Schema
 from databricks import agents
 from databricks.sdk import WorkspaceClient
 from databricks.sdk.service.serving import EndpointStateReady, EndpointStateConfigUpdate
 import time
 from .prompt import REVIEW_APP_INSTRUCTIONS
 
+# Inputs the chain reads next to `messages` (see `chain.AnswerChain.get_input_schema`). Model serving only passes on
+# the columns of the signature, so they are declared in it as optional ones.
+OPTIONAL_CHAIN_INPUTS = {"reference_mode": DataType.string, "return_timings": DataType.boolean, "bypass_cache": DataType.boolean}
+
+def chain_signature(input_example, output_example) -> ModelSignature:
+    signature = infer_signature(input_example, output_example)
+    optional_inputs = [ColSpec(dtype, name, required=False) for name, dtype in OPTIONAL_CHAIN_INPUTS.items()]
+    return ModelSignature(inputs=Schema(signature.inputs.inputs + optional_inputs), outputs=signature.outputs)
+
 class DeploymentManager:
     def __init__(self, model_name_full_path: str) -> None:
         if len(model_name_full_path.split('.')) != 3:
@@ -13,14 +23,14 @@ class DeploymentManager:
         self.model_name = model_name_full_path.split('.')[-1]
         self.model_name_full_path = self.model_name_full_path.replace('`', '')
 
-    def log_model(self, model_py_path: str, config_yaml_path: str, run_name: str):
+    def log_model(self, model_py_path: str, config_yaml_path: str, run_name: str, code_paths: list = None, extra_pip_requirements: list = None):
         if '.yaml' not in config_yaml_path:
             raise Exception("Parameter `config_yaml_path` should be a YAML file.") 
         if '.py' not in model_py_path:
             raise Exception("Parameter `model_py_path` should be a PY file.") 
         
         self.model_config = ModelConfig(development_config=config_yaml_path)
-        signature = infer_signature(self.model_config.get("input_example"), self.model_config.get("output_example")) #'[string (required)]')
+        signature = chain_signature(self.model_config.get("input_example"), self.model_config.get("output_example"))
 
         # Log the model to MLflow
         with mlflow.start_run(run_name=run_name):
@@ -28,6 +38,8 @@ class DeploymentManager:
                 lc_model=model_py_path,
                 model_config=config_yaml_path,  # Chain configuration 
                 artifact_path="chain",  # Required by MLflow
+                code_paths=code_paths,  # Modules imported by the chain, added to its sys.path when it is loaded
+                extra_pip_requirements=extra_pip_requirements,  # Added to the requirements MLflow infers for the serving environment
                 # input_example=model_config.get("input_example"),  # Save the chain's input schema.  MLflow will execute the chain before logging & capture it's output schema.
                 # example_no_conversion=True,  # Required by MLflow to use the input_example as the chain's schema
                 signature=signature
@@ -36,9 +48,14 @@ class DeploymentManager:
         # Register the chain to UC
         self.uc_registered_model_info = mlflow.register_model(model_uri=self.logged_chain_info.model_uri, name=self.model_name)
 
-    def deploy_model(self):
+    def deploy_model(self, environment_vars: dict = None):
         # Deploy to enable the Review APP and create an API endpoint
-        self.deployment_info = agents.deploy(model_name=self.model_name_full_path, model_version=self.uc_registered_model_info.version, scale_to_zero=True)
+        self.deployment_info = agents.deploy(
+            model_name=self.model_name_full_path,
+            model_version=self.uc_registered_model_info.version,
+            scale_to_zero=True,
+            environment_vars=environment_vars,
+        )
 
         # Add the user-facing instructions to the Review App
         agents.set_review_instructions(self.model_name_full_path, REVIEW_APP_INSTRUCTIONS)
@@ -0,0 +1,75 @@
+from .utils import spark, EMBEDDING_MODEL, EMBEDDING_COLUMN
+import pyspark.sql.functions as F
+from pyspark.sql import Column, DataFrame
+from delta.tables import DeltaTable
+from typing import Callable
+
+
+def text_fingerprint(col: str = 'content') -> Column:
+    # Whitespace is collapsed so that chunks differing only in extraction spacing share the same key
+    return F.sha2(F.trim(F.regexp_replace(F.col(col), r'\s+', ' ')), 256)
+
+
+class EmbeddingCache:
+    def __init__(self, table_name: str, model_name: str = EMBEDDING_MODEL) -> None:
+        self.table_name = table_name
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        spark.sql(f"""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                model STRING,
+                content_hash STRING,
+                embedding ARRAY<FLOAT>
+            ) USING DELTA
+        """)
+
+    def _cached_embeddings(self) -> DataFrame:
+        return (
+            spark.table(self.table_name)
+            .filter(F.col('model') == self.model_name)
+            .select('content_hash', F.col('embedding').alias('cached_embedding'))
+        )
+
+    def embed(self, df: DataFrame, embedding_udf: Callable[[Column], Column], text_col: str = 'content') -> DataFrame:
+        df = (
+            df
+            .withColumn('content_hash', text_fingerprint(text_col))
+            .join(self._cached_embeddings(), on='content_hash', how='left')
+            .withColumn('cache_hit', F.col('cached_embedding').isNotNull())
+        )
+
+        # Hits and misses are kept in separate branches: Spark evaluates a pandas UDF on every row of its input,
+        # even when it sits in a conditional expression, so only the misses branch may reference the endpoint
+        hits = df.filter(F.col('cache_hit')).withColumn(EMBEDDING_COLUMN, F.col('cached_embedding'))
+        misses = df.filter(~F.col('cache_hit')).withColumn(EMBEDDING_COLUMN, embedding_udf(F.col(text_col)))
+
+        return hits.unionByName(misses).drop('cached_embedding')
+
+    def update(self, df: DataFrame) -> None:
+        # `df` is the output of `embed`: record the run statistics and store the newly computed embeddings
+        counts = {r['cache_hit']: r['count'] for r in df.groupBy('cache_hit').count().collect()}
+        self.hits += counts.get(True, 0)
+        self.misses += counts.get(False, 0)
+
+        new_embeddings = (
+            df
+            .filter(~F.col('cache_hit') & F.col(EMBEDDING_COLUMN).isNotNull())
+            .select(F.lit(self.model_name).alias('model'), 'content_hash', EMBEDDING_COLUMN)
+            .dropDuplicates(['model', 'content_hash'])
+        )
+        (
+            DeltaTable.forName(spark, self.table_name)
+            .alias('target').merge(
+                new_embeddings.alias('source'),
+                "source.model = target.model AND source.content_hash = target.content_hash"
+            )
+            .whenNotMatchedInsertAll()
+            .execute()
+        )
+
+    def report(self) -> dict:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.
+        print(f"Embedding cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)")
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate}
@@ -0,0 +1,148 @@
+import mlflow.deployments
+import requests
+import random
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough upper bound for English text (~4 characters per token), good enough to size the requests
+    return len(text) // 4 + 1
+
+
+def http_predict_fn(url: str, headers: Dict[str, str] = None, timeout: float = 60.) -> Callable[[List[str]], List[List[float]]]:
+    # Calls an endpoint speaking the Databricks embeddings REST format directly, e.g. a local fake endpoint in tests
+    session = requests.Session()
+
+    def predict(inputs: List[str]) -> List[List[float]]:
+        response = session.post(url, json={"input": inputs}, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        return [e['embedding'] for e in response.json()['data']]
+
+    return predict
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+    return status_code in RETRYABLE_STATUS_CODES
+
+
+class EmbeddingClient:
+    def __init__(
+        self,
+        endpoint: str,
+        predict_fn: Callable[[List[str]], List[List[float]]] = None,
+        max_batch_size: int = 150,
+        max_batch_tokens: int = 32000,
+        max_workers: int = 4,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.,
+        token_counter: Callable[[str], int] = estimate_tokens,
+    ) -> None:
+        self.endpoint = endpoint
+        self.predict_fn = predict_fn if predict_fn is not None else self._predict_with_deploy_client
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_counter = token_counter
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._deploy_client = None
+        self._stats_lock = threading.Lock()
+        self.embedded = 0
+        self.failed = 0
+        self.requests = 0
+        self.elapsed = 0.
+
+    def _predict_with_deploy_client(self, inputs: List[str]) -> List[List[float]]:
+        if self._deploy_client is None:
+            self._deploy_client = mlflow.deployments.get_deploy_client("databricks")
+        response = self._deploy_client.predict(endpoint=self.endpoint, inputs={"input": inputs})
+        return [e['embedding'] for e in response.data]
+
+    def _make_batches(self, texts: List[str]) -> List[List[int]]:
+        # Batches hold indices into `texts` and are closed as soon as either the item or the token limit is reached
+        batches, batch, batch_tokens = [], [], 0
+        for i, text in enumerate(texts):
+            tokens = self.token_counter(text)
+            if batch and (len(batch) >= self.max_batch_size or batch_tokens + tokens > self.max_batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _predict_with_retries(self, inputs: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._stats_lock:
+                    self.requests += 1
+                return self.predict_fn(inputs)
+            except Exception as e:
+                if not _is_retryable(e) or attempt == self.max_retries:
+                    raise e
+                # Full jitter, so that the concurrent batches of every executor don't retry in lockstep
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def _embed_batch(self, inputs: List[str]) -> List[Optional[List[float]]]:
+        try:
+            return self._predict_with_retries(inputs)
+        except Exception as e:
+            if len(inputs) == 1:
+                warnings.warn(f"Exception {e} has been thrown during embedding creation")
+                with self._stats_lock:
+                    self.failed += 1
+                return [None]
+            # Split the batch in half to isolate the inputs the endpoint keeps rejecting
+            half = len(inputs) // 2
+            return self._embed_batch(inputs[:half]) + self._embed_batch(inputs[half:])
+
+    def embed(self, texts: List[str]) -> List[Optional[List[float]]]:
+        start = time.perf_counter()
+        batches = self._make_batches(texts)
+        futures = [self.executor.submit(self._embed_batch, [texts[i] for i in batch]) for batch in batches]
+
+        embeddings = [None] * len(texts)
+        for batch, future in zip(batches, futures):
+            for i, embedding in zip(batch, future.result()):
+                embeddings[i] = embedding
+
+        with self._stats_lock:
+            self.embedded += len(texts)
+            self.elapsed += time.perf_counter() - start
+        return embeddings
+
+    def throughput(self) -> float:
+        return self.embedded / self.elapsed if self.elapsed > 0 else 0.
+
+    def report(self) -> dict:
+        return {
+            'embedded': self.embedded,
+            'failed': self.failed,
+            'requests': self.requests,
+            'embeddings_per_sec': self.throughput(),
+        }
+
+
+# One client per Python worker and settings: Spark reuses its Python workers, so the deploy client and the thread
+# pool survive across Arrow batches and tasks on the same executor
+_clients: Dict[tuple, EmbeddingClient] = {}
+_clients_lock = threading.Lock()
+
+def get_embedding_client(endpoint: str, **kwargs) -> EmbeddingClient:
+    key = (endpoint, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = EmbeddingClient(endpoint, **kwargs)
+        return _clients[key]
@@ -0,0 +1,72 @@
+import io
+from abc import ABC, abstractmethod
+import pyarrow as pa
+import pymupdf
+from pypdf import PdfReader
+from typing import Dict, Iterator, Tuple, Union
+
+PdfReference = Union[str, bytes, pa.Buffer]
+
+
+class PdfTextEngine(ABC):
+    name = None
+
+    @abstractmethod
+    def page_count(self, reference: PdfReference) -> int:
+        pass
+
+    @abstractmethod
+    def iter_pages(self, reference: PdfReference, start: int = 0, end: int = None) -> Iterator[Tuple[str, int, str]]:
+        # Yields (title, page_number, text) for the pages in [start, end)
+        pass
+
+
+class PyPdfEngine(PdfTextEngine):
+    name = 'pypdf'
+
+    def _reader(self, reference: PdfReference) -> PdfReader:
+        if isinstance(reference, pa.Buffer):
+            # BufferReader wraps the Arrow buffer without copying the PDF bytes
+            reference = pa.BufferReader(reference)
+        elif not isinstance(reference, str):
+            reference = io.BytesIO(reference)
+        return PdfReader(reference)
+
+    def page_count(self, reference: PdfReference) -> int:
+        return len(self._reader(reference).pages)
+
+    def iter_pages(self, reference: PdfReference, start: int = 0, end: int = None) -> Iterator[Tuple[str, int, str]]:
+        reader = self._reader(reference)
+        title = reader.metadata.get('/Title') if reader.metadata is not None else None
+        end = len(reader.pages) if end is None else min(end, len(reader.pages))
+        for i in range(start, end):
+            yield title, i, reader.pages[i].extract_text()
+
+
+class PyMuPdfEngine(PdfTextEngine):
+    name = 'pymupdf'
+
+    def _open(self, reference: PdfReference) -> pymupdf.Document:
+        if isinstance(reference, str):
+            return pymupdf.open(reference)
+        if isinstance(reference, pa.Buffer):
+            # PyMuPDF only accepts bytes-like objects it can own, so this is the single copy made per document
+            reference = reference.to_pybytes()
+        return pymupdf.open(stream=reference, filetype='pdf')
+
+    def page_count(self, reference: PdfReference) -> int:
+        with self._open(reference) as doc:
+            return doc.page_count
+
+    def iter_pages(self, reference: PdfReference, start: int = 0, end: int = None) -> Iterator[Tuple[str, int, str]]:
+        with self._open(reference) as doc:
+            title = doc.metadata.get('title') or None
+            end = doc.page_count if end is None else min(end, doc.page_count)
+            for i in range(start, end):
+                yield title, i, doc[i].get_text()
+
+
+PDF_ENGINES: Dict[str, PdfTextEngine] = {
+    'pypdf': PyPdfEngine(),
+    'pymupdf': PyMuPdfEngine(),
+}
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class PartListFetcher:
+    def __init__(
+        self,
+        cache_dir: str = None,
+        max_workers: int = 8,
+        timeout: float = 30.,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        # One pooled session shared by all the worker threads, sized so that no connection is thrown away
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._stats_lock = threading.Lock()
+        self.stats = {'downloaded': 0, 'not_modified': 0, 'failed': 0}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.html'), os.path.join(self.cache_dir, key + '.json')
+
+    def _read_cache(self, url: str) -> Tuple[Optional[bytes], dict]:
+        if self.cache_dir is None:
+            return None, {}
+        html_path, meta_path = self._cache_paths(url)
+        if not os.path.exists(html_path) or not os.path.exists(meta_path):
+            return None, {}
+        with open(html_path, 'rb') as f:
+            content = f.read()
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        return content, meta
+
+    def _write_cache(self, url: str, response: requests.Response) -> None:
+        if self.cache_dir is None:
+            return
+        html_path, meta_path = self._cache_paths(url)
+        with open(html_path, 'wb') as f:
+            f.write(response.content)
+        with open(meta_path, 'w') as f:
+            json.dump({'url': url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}, f)
+
+    def _count(self, stat: str) -> None:
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def fetch(self, url: str) -> Optional[bytes]:
+        cached_content, meta = self._read_cache(url)
+
+        # Conditional request: an unchanged page costs a 304 without a body
+        headers = {}
+        if cached_content is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if cached_content is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and cached_content is not None:
+                self._count('not_modified')
+                return cached_content
+            response.raise_for_status()
+        except Exception as e:
+            self._count('failed')
+            warnings.warn(f"Exception {e} has been thrown while fetching {url}")
+            # A stale copy is better than losing the part list altogether
+            return cached_content
+
+        self._write_cache(url, response)
+        self._count('downloaded')
+        return response.content
+
+    def fetch_all(self, urls: List[str]) -> Iterator[Tuple[str, Optional[bytes]]]:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from zip(urls, executor.map(self.fetch, urls))
@@ -6,9 +6,16 @@ from .utils import (
     PDFS_FOLDER,
     QR_CODES_DIR,
     PARTS_LIST_TABLE,
+    PARTS_LIST_CACHE_FOLDER,
     URLS,
     RAW_PDF_TABLE,
     CLEAN_PDF_TABLE,
+    EMBEDDING_CACHE_TABLE,
+    QR_CODES_TABLE,
+    PAGE_IMAGES_TABLE,
+    PAGE_IMAGES_PATH,
+    PRECOMPUTED_ANSWERS_TABLE,
+    PRECOMPUTED_ANSWERS_PATH,
     PDFS_TABLE_FULLNAME,
     VECTOR_SEARCH_ENDPOINT_NAME,
     VS_INDEX_FULLNAME,
@@ -18,12 +25,16 @@ from .utils import (
     CHAIN_CONFIG_FILE,
     RAG_CONFIG,
     MODEL_NAME,
+    SERVING_ENVIRONMENT_VARS,
     MODEL_SCRIPT_PATH,
+    MODEL_CODE_PATHS,
+    MODEL_PIP_REQUIREMENTS,
 )
 from .autoloader import AutoLoader
 from .preprocessing import QRCodeScraper
 from .vector_search import VectorStore
 from .deployment import DeploymentManager
+from .precompute import AnswerPrecomputer
 import yaml
 
 
@@ -46,13 +57,19 @@ def main():
 
     # Load data into Unity Catalog
     print("Uploading PDFs to Volume...")
-    loader = AutoLoader(catalog, schema, volume, pdfs_folder)
-    loader.load_pdfs_to_catalog(URLS, RAW_PDF_TABLE, CLEAN_PDF_TABLE)
+    loader = AutoLoader(catalog, schema, volume, pdfs_folder, embedding_cache_table=EMBEDDING_CACHE_TABLE)
+    loader.load_pdfs_to_catalog(
+        URLS, RAW_PDF_TABLE, CLEAN_PDF_TABLE,
+        qr_codes_table_name=QR_CODES_TABLE,
+        page_images_table_name=PAGE_IMAGES_TABLE,
+        page_images_path=PAGE_IMAGES_PATH,
+    )
 
-    # Extract QR codes
-    print("Extracting QR codes from PDFs...")
-    qr_codes_scraper = QRCodeScraper()
-    qr_codes_scraper.scrape(loader.pdf_urls, save_to_table=PARTS_LIST_TABLE, write_dir=None) # write_dir=QR_CODES_DIR)
+    # Scrape the part lists behind the QR codes extracted during the load
+    print("Scraping part lists from QR codes...")
+    qr_code_urls = [r.qr_code_url for r in spark.table(QR_CODES_TABLE).select('qr_code_url').distinct().collect()]
+    qr_codes_scraper = QRCodeScraper(cache_dir=loader.volume + '/' + PARTS_LIST_CACHE_FOLDER)
+    qr_codes_scraper.scrape_part_lists(qr_code_urls, save_to_table=PARTS_LIST_TABLE)
 
     # Create Vector Store for user query retrieval
     print("Deploying Vector Store...")
@@ -62,9 +79,14 @@ def main():
     # Log and deploy model
     deployment_manager = DeploymentManager(model_name_full_path = f"{catalog}.{schema}.{MODEL_NAME}")
     print("Logging model experiment...")
-    deployment_manager.log_model(MODEL_SCRIPT_PATH, CHAIN_CONFIG_FILE, run_name="hackathon_rag")
+    deployment_manager.log_model(MODEL_SCRIPT_PATH, CHAIN_CONFIG_FILE, run_name="hackathon_rag", code_paths=MODEL_CODE_PATHS, extra_pip_requirements=MODEL_PIP_REQUIREMENTS)
     print("Deploying model...")
-    deployment_manager.deploy_model()
+    deployment_manager.deploy_model(environment_vars=SERVING_ENVIRONMENT_VARS)
+
+    # Answer the prompts of the UI dropdowns against the freshly synced index, the endpoint serves them as they are
+    print("Precomputing answers...")
+    precomputer = AnswerPrecomputer(deployment_manager.logged_chain_info.model_uri, VECTOR_SEARCH_ENDPOINT_NAME, VS_INDEX_FULLNAME)
+    precomputer.run(PARTS_LIST_TABLE, PRECOMPUTED_ANSWERS_TABLE, PRECOMPUTED_ANSWERS_PATH, qr_codes_table=QR_CODES_TABLE)
 
 
 if __name__ == "__main__":
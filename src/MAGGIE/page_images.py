@@ -0,0 +1,42 @@
+import io
+import os
+from typing import Dict, Iterator
+
+import pymupdf
+from PIL import Image
+from .rendering import PageRasterizer
+from .page_store import page_image_path
+
+PAGE_IMAGE_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+
+def encode_page_image(page: pymupdf.Page, rasterizer: PageRasterizer, image_format: str, quality: int) -> bytes:
+    # The encoder reads straight from the rasterizer's pixmap
+    img = Image.fromarray(rasterizer.render(page))
+    buffer = io.BytesIO()
+    img.save(buffer, format=PAGE_IMAGE_FORMATS[image_format], quality=quality)
+    return buffer.getvalue()
+
+
+def write_page_images(
+    doc: pymupdf.Document,
+    path: str,
+    root: str,
+    resolutions: Dict[str, int],
+    image_format: str = 'webp',
+    quality: int = 80,
+    start: int = 0,
+    end: int = None,
+) -> Iterator[dict]:
+    # Renders every page of the range once per resolution (name -> DPI) and yields a manifest row per written image
+    end = doc.page_count if end is None else min(end, doc.page_count)
+    rasterizers = {resolution: PageRasterizer(dpi=dpi) for resolution, dpi in resolutions.items()}
+    os.makedirs(os.path.dirname(page_image_path(root, path, 0, '', image_format)), exist_ok=True)
+    for page_number in range(start, end):
+        page = doc[page_number]
+        for resolution, rasterizer in rasterizers.items():
+            image_path = page_image_path(root, path, page_number, resolution, image_format)
+            data = encode_page_image(page, rasterizer, image_format, quality)
+            with open(image_path, 'wb') as f:
+                f.write(data)
+            yield dict(path=path, page_number=page_number, resolution=resolution, image_path=image_path, size=len(data))
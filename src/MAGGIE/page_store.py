@@ -0,0 +1,13 @@
+import hashlib
+
+# Layout of the pre-rendered page image store. Kept free of any other import: the ingest job writes the store through
+# `page_images.write_page_images` and the serving chain, which can't import the MAGGIE package, reads it with this
+# same module logged next to chain.py (see `MODEL_CODE_PATHS`). Changing the layout requires re-rendering the store.
+
+
+def document_id(path: str) -> str:
+    return hashlib.sha256(path.encode('utf-8')).hexdigest()[:16]
+
+
+def page_image_path(root: str, path: str, page_number: int, resolution: str, image_format: str) -> str:
+    return f"{root}/{document_id(path)}/{page_number}_{resolution}.{image_format}"
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List
+
+import mlflow
+import pandas as pd
+import pyspark.sql.functions as F
+from databricks.vector_search.client import VectorSearchClient
+from delta.tables import DeltaTable
+from .utils import spark, MAINTENANCE_TYPES, MAX_PRECOMPUTED_PROMPTS, PRECOMPUTE_WORKERS
+from .prompt import STRUCTURED_PROMPT_TEMPLATE
+
+# The dropdown prompts are only asked from the Dash UI, which fetches the page images itself
+PRECOMPUTED_REFERENCE_MODE = 'lazy'
+
+
+def build_structured_prompt(maintenance_type: str, qr_code_part: str, partlist_part: List[str]) -> str:
+    part_list_bullet_points = "\n\t".join([f"- {part}" for part in partlist_part])
+    return STRUCTURED_PROMPT_TEMPLATE.format(maintenance_type=maintenance_type, qr_code_part=qr_code_part, part_list_bullet_points=part_list_bullet_points)
+
+
+def prompt_fingerprint(prompt: str) -> str:
+    # Same normalization as `chain.normalize_query`
+    return hashlib.sha256(" ".join(prompt.split()).lower().encode('utf-8')).hexdigest()
+
+
+def read_index_version(index) -> str:
+    # Same version as `chain.get_index_version`: answers are only served against the index they were computed on
+    status = index.describe().get("status", {})
+    update_status = status.get("triggered_update_status") or status.get("continuous_update_status") or {}
+    version = update_status.get("last_processed_commit_version", status.get("indexed_row_count"))
+    return None if version is None else str(version)
+
+
+class AnswerPrecomputer:
+    def __init__(self, model_uri: str, vector_search_endpoint_name: str, index_name: str, max_workers: int = PRECOMPUTE_WORKERS) -> None:
+        self.model_uri = model_uri
+        self.index = VectorSearchClient(disable_notice=True).get_index(endpoint_name=vector_search_endpoint_name, index_name=index_name)
+        self.max_workers = max_workers
+
+    def enumerate_prompts(self, part_lists_table: str, qr_codes_table: str = None, limit: int = MAX_PRECOMPUTED_PROMPTS) -> pd.DataFrame:
+        # A conversation started from the dropdowns asks about one assembly (part_name) and, most often, a single part
+        # of its list (designation). Parts referenced by more manual pages come first.
+        parts = spark.table(part_lists_table).select('part_name', 'designation', 'qr_code_url').dropna().distinct()
+        if qr_codes_table is not None:
+            references = spark.table(qr_codes_table).groupBy('qr_code_url').agg(F.count('*').alias('references'))
+            parts = parts.join(references, on='qr_code_url', how='left').fillna(0, subset=['references'])
+        else:
+            parts = parts.withColumn('references', F.lit(0))
+        parts = (
+            parts.groupBy('part_name', 'designation').agg(F.sum('references').alias('references'))
+            .orderBy(F.desc('references'), 'part_name', 'designation')
+            .limit(max(limit // len(MAINTENANCE_TYPES), 1))
+            .toPandas()
+        )
+
+        prompts = [
+            dict(maintenance_type=maintenance_type, part_name=row.part_name, designation=row.designation, prompt=build_structured_prompt(maintenance_type, row.part_name, [row.designation]))
+            for row in parts.itertuples()
+            for maintenance_type in MAINTENANCE_TYPES
+        ]
+        df = pd.DataFrame(prompts, columns=['maintenance_type', 'part_name', 'designation', 'prompt'])
+        df['prompt_fingerprint'] = df['prompt'].map(prompt_fingerprint)
+        return df.drop_duplicates('prompt_fingerprint')
+
+    def answer(self, prompts: List[str]) -> List[str]:
+        chain = mlflow.langchain.load_model(self.model_uri)
+
+        def invoke(prompt):
+            try:
+                # The answer cache is bypassed: it could return the answer of a near-identical prompt (e.g. another maintenance type)
+                return chain.invoke({"messages": [{"role": "user", "content": prompt}], "bypass_cache": True, "reference_mode": PRECOMPUTED_REFERENCE_MODE})
+            except Exception as e:
+                warnings.warn(f"Exception {e} has been thrown while answering: {prompt}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(invoke, prompts))
+
+    def run(self, part_lists_table: str, save_table_name: str, snapshot_path: str, qr_codes_table: str = None) -> None:
+        # The version is read before answering, so answers computed while a sync lands are never served against the new index
+        index_version = read_index_version(self.index)
+        if index_version is None:
+            warnings.warn("The version of the vector search index is unknown: no answers are precomputed")
+            return
+        prompts = self.enumerate_prompts(part_lists_table, qr_codes_table)
+        prompts['answer'] = self.answer(prompts['prompt'].tolist())
+        prompts = prompts.dropna(subset=['answer'])
+        prompts['index_version'] = index_version
+        prompts['computed_at'] = datetime.now()
+        print(f"Precomputed {len(prompts)} answers for index version {index_version}")
+        if len(prompts) == 0:
+            return
+
+        spark.sql(f"""
+            CREATE TABLE IF NOT EXISTS {save_table_name} (
+                prompt_fingerprint STRING,
+                index_version STRING,
+                maintenance_type STRING,
+                part_name STRING,
+                designation STRING,
+                prompt STRING,
+                answer STRING,
+                computed_at TIMESTAMP
+            ) USING DELTA
+        """)
+        (
+            DeltaTable.forName(spark, save_table_name)
+            .alias('target').merge(
+                spark.createDataFrame(prompts).alias('source'),
+                "source.prompt_fingerprint = target.prompt_fingerprint AND source.index_version = target.index_version"
+            )
+            .whenMatchedUpdateAll()
+            .whenNotMatchedInsertAll()
+            .execute()
+        )
+
+        # The serving chain reads a single JSON file instead of querying the table on every request
+        with open(snapshot_path, 'w') as f:
+            json.dump({
+                "index_version": index_version,
+                "reference_mode": PRECOMPUTED_REFERENCE_MODE,
+                "answers": dict(zip(prompts['prompt_fingerprint'], prompts['answer'])),
+            }, f)
@@ -1,11 +1,25 @@
-from .utils import spark, EMBEDDING_MODEL, EMBEDDING_COLUMN, PARSER
+from .utils import (
+    spark,
+    EMBEDDING_MODEL,
+    EMBEDDING_COLUMN,
+    EMBEDDING_MAX_BATCH_SIZE,
+    EMBEDDING_MAX_BATCH_TOKENS,
+    EMBEDDING_CONCURRENCY,
+    PDF_ENGINE,
+    PAGES_PER_WORK_UNIT,
+    CHUNKS_PER_OUTPUT_BATCH,
+    PAGE_IMAGE_RESOLUTIONS,
+    PAGE_IMAGE_FORMAT,
+    PAGE_IMAGE_QUALITY,
+    PARSER,
+)
 import pyspark.sql.functions as F
-from pyspark.sql import DataFrame
-import mlflow.deployments
+from pyspark.sql import DataFrame, Window
 import pandas as pd
-from typing import Iterator, List, Union
+import pyarrow as pa
+from typing import Dict, Iterator, List, Tuple, Union
 import io
-from pypdf import PdfReader
+import hashlib
 import warnings
 from llama_index.core import Document
 from PIL import Image
@@ -16,52 +30,52 @@ import os
 import requests
 from bs4 import BeautifulSoup
 from delta.tables import DeltaTable
-
-def get_reader(reference: Union[str, bytearray]):
-    if isinstance(reference, str):
-        pdf = reference
-    else:
-        pdf = io.BytesIO(reference)
-    return PdfReader(pdf)
-
-def read_pdf(reference: Union[str, bytes]):
+from .embedding_cache import EmbeddingCache
+from .embedding_client import get_embedding_client
+from .extraction import PDF_ENGINES
+from .qr_detection import iter_qr_codes, qr_regions, scan_document
+from .fetching import PartListFetcher
+from .rendering import PageRasterizer
+from .page_images import write_page_images
+
+def iter_pdf_pages(reference: Union[str, bytes, pa.Buffer], start: int = 0, end: int = None, engine: str = PDF_ENGINE) -> Iterator[Tuple[str, int, str]]:
+    return PDF_ENGINES[engine].iter_pages(reference, start=start, end=end)
+
+def read_pdf(reference: Union[str, bytes], engine: str = PDF_ENGINE):
     try:
-        reader = get_reader(reference)
-        return [[reader.metadata['/Title'], i, page_content.extract_text()] for i, page_content in enumerate(reader.pages)]
+        return [list(page) for page in iter_pdf_pages(reference, engine=engine)]
     except Exception as e:
         warnings.warn(f"Exception {e} has been thrown during parsing")
         return None
 
+def split_text(txt: str) -> List[str]:
+    if txt is None:
+        return []
+    nodes = PARSER.get_nodes_from_documents([Document(text=txt)])
+    return [n.text for n in nodes]
+
+def page_fingerprint(txt: str) -> str:
+    # Same value as F.sha2(F.coalesce(text, ''), 256) in Spark
+    return hashlib.sha256((txt or '').encode('utf-8')).hexdigest()
+
 
 @F.pandas_udf("array<float>")
 def get_embedding(contents: pd.Series) -> pd.Series:
-    deploy_client = mlflow.deployments.get_deploy_client("databricks")
-    def get_embeddings(batch):
-        #Note: this will fail if an exception is thrown during embedding creation (add try/except if needed) 
-        response = deploy_client.predict(endpoint=EMBEDDING_MODEL, inputs={"input": batch})
-        return [e['embedding'] for e in response.data]
-
-    # Splitting the contents into batches of 150 items each, since the embedding model takes at most 150 inputs per request.
-    max_batch_size = 150
-    batches = [contents.iloc[i:i + max_batch_size] for i in range(0, len(contents), max_batch_size)]
-
-    # Process each batch and collect the results
-    all_embeddings = []
-    for batch in batches:
-        all_embeddings += get_embeddings(batch.tolist())
-
-    return pd.Series(all_embeddings)
+    client = get_embedding_client(
+        EMBEDDING_MODEL,
+        max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+        max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+        max_workers=EMBEDDING_CONCURRENCY,
+    )
+    # Chunks that still fail after retries and batch splitting get a null embedding instead of failing the task
+    embeddings = client.embed(contents.tolist())
+    print(f"Embedded {len(embeddings)} chunks, {client.throughput():.1f} embeddings/sec on this executor")
+    return pd.Series(embeddings)
 
 @F.pandas_udf("array<string>")
 def split_in_chunks(batch_iter: Iterator[pd.Series]) -> Iterator[pd.Series]:
-    def extract_and_split_page(txt):
-      if txt is None:
-        return []
-      nodes = PARSER.get_nodes_from_documents([Document(text=txt)])
-      return [n.text for n in nodes]
-    
     for x in batch_iter:
-        yield x.apply(extract_and_split_page)
+        yield x.apply(split_text)
 
 @F.pandas_udf("array<struct<title:string, page_number:int, text:string>>")
 def extract_pages_content(batch_iter: Iterator[pd.Series]) -> Iterator[pd.Series]: 
@@ -69,48 +83,347 @@ def extract_pages_content(batch_iter: Iterator[pd.Series]) -> Iterator[pd.Series
         yield x.apply(read_pdf)
 
 
-def preprocess(df: DataFrame, save_table_name: str) -> DataFrame:
+CHUNK_COLUMNS = ['path', 'title', 'url', 'page_number', 'page_hash', 'chunk_index', 'content', EMBEDDING_COLUMN]
+CHUNK_KEY = ['path', 'page_number', 'chunk_index']
+PREPROCESS_SCHEMA = pa.schema([
+    ('path', pa.string()),
+    ('title', pa.string()),
+    ('url', pa.string()),
+    ('page_number', pa.int32()),
+    ('page_hash', pa.string()),
+    ('chunk_index', pa.int32()),
+    ('content', pa.string()),
+    (EMBEDDING_COLUMN, pa.list_(pa.float32())),
+])
+
+def create_chunks_table(table_name: str) -> None:
     spark.sql(f"""
-        CREATE TABLE IF NOT EXISTS {save_table_name} (
+        CREATE TABLE IF NOT EXISTS {table_name} (
             id BIGINT GENERATED BY DEFAULT AS IDENTITY,
             path STRING,
             title STRING,
             url STRING,
             page_number INT,
+            page_hash STRING,
+            chunk_index INT,
             content STRING,
             embedding ARRAY<FLOAT>
         ) USING DELTA
         TBLPROPERTIES (delta.enableChangeDataFeed = true)
     """)
-    
-    return (
-        df
-        .withColumn('url', F.col('path'))
-        .withColumn('path', F.regexp_replace(F.col("path"), 'dbfs:', ''))
-        .withColumn("extracted_content", F.explode(extract_pages_content("content")))
-        .select(
-            "path",
-            "url",
-            "content",
-            F.col("extracted_content.title").alias("title"),
-            F.col("extracted_content.page_number").alias("page_number"),
-            F.col("extracted_content.text").alias("text")
+
+    # Tables created before the page-level upserts don't have the fingerprint columns yet
+    existing_columns = spark.table(table_name).columns
+    missing_columns = [c for c in ['page_hash STRING', 'chunk_index INT'] if c.split(' ')[0] not in existing_columns]
+    if len(missing_columns) > 0:
+        spark.sql(f"ALTER TABLE {table_name} ADD COLUMNS ({', '.join(missing_columns)})")
+
+def latest_versions(df: DataFrame) -> DataFrame:
+    # A re-published manual shows up as a new version of the same file: keep only the most recent one
+    window = Window.partitionBy('path').orderBy(F.col('modificationTime').desc())
+    return df.withColumn('version_rank', F.row_number().over(window)).filter('version_rank = 1').drop('version_rank')
+
+def processed_paths(df: DataFrame) -> List[str]:
+    # The only action run on the micro-batch: the work units are planned from the file paths and every task reads the
+    # PDF bytes it needs from the volume, so the PDF binaries of the batch are never read nor shuffled
+    return [r.path for r in df.select('path').distinct().collect()]
+
+def get_indexed_pages(paths: List[str], table_name: str) -> Dict[Tuple[str, int], str]:
+    rows = (
+        spark.table(table_name)
+        .filter(F.col('path').isin([p.replace('dbfs:', '') for p in paths]))
+        .select('path', 'page_number', 'page_hash')
+        .distinct()
+        .collect()
+    )
+    return {(r.path, r.page_number): r.page_hash for r in rows}
+
+PAGE_RANGE_SCHEMA = pa.schema([
+    ('path', pa.string()),
+    ('page_start', pa.int32()),
+    ('page_end', pa.int32()),
+])
+
+def plan_page_ranges(batches: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+    # Only the page tree is parsed here, text extraction happens later in `chunk_pdfs`
+    for batch in batches:
+        rows = []
+        for url in batch.column('path').to_pylist():
+            try:
+                nr_pages = PDF_ENGINES[PDF_ENGINE].page_count(url.replace('dbfs:', ''))
+            except Exception as e:
+                warnings.warn(f"Exception {e} has been thrown during parsing of {url}")
+                continue
+            rows += [
+                dict(path=url, page_start=start, page_end=min(start + PAGES_PER_WORK_UNIT, nr_pages))
+                for start in range(0, nr_pages, PAGES_PER_WORK_UNIT)
+            ]
+        yield pa.RecordBatch.from_pylist(rows, schema=PAGE_RANGE_SCHEMA)
+
+def plan_work_units(paths: List[str]) -> DataFrame:
+    # The files are counted in parallel and the plan is tiny (one row per page range), so it is collected to size the
+    # fan-out exactly
+    files = spark.createDataFrame([(p,) for p in paths], schema="path string").repartition(max(len(paths), 1))
+    ranges = files.mapInArrow(plan_page_ranges, PAGE_RANGE_SCHEMA).collect()
+    units = spark.createDataFrame(ranges, schema="path string, page_start int, page_end int")
+
+    # Round-robin partitioning spreads the ranges evenly over the cluster, so a 600-page catalog no longer lands on a
+    # single task. Only the path and the range are shuffled, each task reads the PDF from the volume itself.
+    return units.repartition(max(len(ranges), 1))
+
+def chunk_pdfs(indexed_pages: Dict[Tuple[str, int], str], embed: bool = True):
+    # Fused PDF -> pages -> chunks -> embeddings stage over the work units of `plan_work_units`. Each PDF is read from
+    # the volume by the extraction engine and only the chunk rows leave the task. Unchanged pages emit a single
+    # manifest row (no chunk_index/content) so that the upsert still knows which pages currently exist.
+    def embed_rows(rows: List[dict]) -> pa.RecordBatch:
+        if embed:
+            chunk_rows = [r for r in rows if r['content'] is not None]
+            client = get_embedding_client(
+                EMBEDDING_MODEL,
+                max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+                max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+                max_workers=EMBEDDING_CONCURRENCY,
+            )
+            for r, embedding in zip(chunk_rows, client.embed([r['content'] for r in chunk_rows])):
+                r[EMBEDDING_COLUMN] = embedding
+        return pa.RecordBatch.from_pylist(rows, schema=PREPROCESS_SCHEMA)
+
+    def process(batches: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+        rows = []
+        for batch in batches:
+            urls = batch.column('path').to_pylist()
+            page_starts = batch.column('page_start').to_pylist()
+            page_ends = batch.column('page_end').to_pylist()
+            for i, url in enumerate(urls):
+                path = url.replace('dbfs:', '')
+                # The rows of a work unit are only emitted once all its pages are parsed: a unit that fails partway
+                # through is replaced by a single row without page_number, so that `upsert_chunks` leaves the file alone
+                unit_rows = []
+                try:
+                    pages = iter_pdf_pages(path, start=page_starts[i], end=page_ends[i])
+                    for title, page_number, text in pages:
+                        page_hash = page_fingerprint(text)
+                        page = dict(path=path, title=title, url=url, page_number=page_number, page_hash=page_hash, chunk_index=None, content=None)
+                        if indexed_pages.get((path, page_number)) == page_hash:
+                            unit_rows.append(page)
+                            continue
+                        unit_rows += [dict(page, chunk_index=j, content=chunk) for j, chunk in enumerate(split_text(text))]
+                except Exception as e:
+                    warnings.warn(f"Exception {e} has been thrown during parsing of {path}")
+                    unit_rows = [dict(path=path, title=None, url=url, page_number=None, page_hash=None, chunk_index=None, content=None)]
+
+                rows += unit_rows
+                if len(rows) >= CHUNKS_PER_OUTPUT_BATCH:
+                    yield embed_rows(rows)
+                    rows = []
+        if len(rows) > 0:
+            yield embed_rows(rows)
+
+    return process
+
+def preprocess(df: DataFrame, save_table_name: str, embedding_cache: EmbeddingCache = None) -> DataFrame:
+    create_chunks_table(save_table_name)
+
+    # Only pages that are new or whose text changed since the last run are chunked and embedded
+    paths = processed_paths(df)
+    rows = plan_work_units(paths).mapInArrow(
+        chunk_pdfs(get_indexed_pages(paths, save_table_name), embed=embedding_cache is None),
+        PREPROCESS_SCHEMA
+    )
+
+    if embedding_cache is not None:
+        # The manifest and the chunks, and within `embed` the cache hits and misses, are separate branches of the
+        # parsed rows: checkpointed, so that the PDFs are parsed and chunked once rather than once per branch
+        rows = rows.localCheckpoint()
+        # Only the chunks whose text has never been embedded with the current model reach the endpoint
+        chunks = embedding_cache.embed(rows.filter(F.col('content').isNotNull()).drop(EMBEDDING_COLUMN), get_embedding, text_col="content")
+        manifest = (
+            rows.filter(F.col('content').isNull())
+            .withColumn('content_hash', F.lit(None).cast('string'))
+            .withColumn('cache_hit', F.lit(None).cast('boolean'))
+        )
+        rows = manifest.unionByName(chunks)
+
+    return rows
+
+def upsert_chunks(rows: DataFrame, table_name: str) -> None:
+    target = DeltaTable.forName(spark, table_name)
+    columns = {c: f"source.{c}" for c in CHUNK_COLUMNS}
+
+    # A file with a work unit that failed to parse is left untouched as a whole: its other pages alone can't tell
+    # which of the indexed chunks are stale
+    failed_paths = [r.path for r in rows.filter(F.col('page_number').isNull()).select('path').distinct().collect()]
+    rows = rows.filter(~F.col('path').isin(failed_paths))
+
+    # Chunks whose embedding failed are left out rather than indexed without a vector
+    chunks = rows.filter(F.col('content').isNotNull() & F.col(EMBEDDING_COLUMN).isNotNull()).select(*CHUNK_COLUMNS)
+    (
+        target.alias('target').merge(
+            chunks.alias('source'),
+            " AND ".join([f"source.{c} = target.{c}" for c in CHUNK_KEY])
         )
-        .withColumn("content", F.explode(split_in_chunks("text")))
-        .withColumn("embedding", get_embedding("content"))
-        .select('path', 'title', 'url', F.col('page_number').cast('int'), 'content', EMBEDDING_COLUMN)
+        .whenMatchedUpdate(set=columns)
+        .whenNotMatchedInsert(values=columns)
+        .execute()
     )
 
+    # Every row of the processed files that doesn't belong to a current page version is stale: chunks of removed
+    # pages and leftover chunks of pages that now split into fewer chunks.
+    pages = rows.select('path', 'page_number', 'page_hash').distinct()
+    paths = [r.path for r in pages.select('path').distinct().collect()]
+    if len(paths) == 0:
+        return
+    (
+        target.alias('target').merge(
+            pages.alias('source'),
+            "source.path = target.path AND source.page_number = target.page_number AND source.page_hash = target.page_hash"
+        )
+        .whenNotMatchedBySourceDelete(condition=F.col('target.path').isin(paths))
+        .execute()
+    )
+
+QR_CODES_SCHEMA = pa.schema([
+    ('path', pa.string()),
+    ('page_number', pa.int32()),
+    ('qr_code_url', pa.string()),
+])
+
+def find_qr_codes(batches: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+    # Renders and decodes the page ranges of `plan_work_units` straight from the PDF binaries on the executors
+    for batch in batches:
+        rows = []
+        urls = batch.column('path').to_pylist()
+        page_starts = batch.column('page_start').to_pylist()
+        page_ends = batch.column('page_end').to_pylist()
+        for i, url in enumerate(urls):
+            path = url.replace('dbfs:', '')
+            # As in `chunk_pdfs`, a unit that fails partway through only emits a row without page_number
+            unit_rows = []
+            try:
+                with pymupdf.open(path) as doc:
+                    for page_number, qr_code_urls in scan_document(doc, start=page_starts[i], end=page_ends[i]):
+                        unit_rows += [dict(path=path, page_number=page_number, qr_code_url=u) for u in qr_code_urls]
+            except Exception as e:
+                warnings.warn(f"Exception {e} has been thrown during QR code extraction of {path}")
+                unit_rows = [dict(path=path, page_number=None, qr_code_url=None)]
+            rows += unit_rows
+        yield pa.RecordBatch.from_pylist(rows, schema=QR_CODES_SCHEMA)
+
+def extract_qr_codes(df: DataFrame, save_table_name: str) -> None:
+    spark.sql(f"""
+        CREATE TABLE IF NOT EXISTS {save_table_name} (
+            path STRING,
+            page_number INT,
+            qr_code_url STRING
+        ) USING DELTA
+        TBLPROPERTIES (delta.enableChangeDataFeed = true)
+    """)
+
+    paths = processed_paths(df)
+    qr_codes = plan_work_units(paths).mapInArrow(find_qr_codes, QR_CODES_SCHEMA).dropDuplicates().persist()
+
+    # Codes of the processed files that are no longer found (e.g. in a re-published manual) are removed, except for
+    # the files that failed to render, whose codes are left as they are
+    failed_paths = [r.path for r in qr_codes.filter(F.col('page_number').isNull()).select('path').distinct().collect()]
+    paths = [p.replace('dbfs:', '') for p in paths if p.replace('dbfs:', '') not in failed_paths]
+    if len(paths) > 0:
+        (
+            DeltaTable.forName(spark, save_table_name)
+            .alias('target').merge(
+                qr_codes.filter(F.col('path').isin(paths)).alias('source'),
+                "source.path = target.path AND source.page_number = target.page_number AND source.qr_code_url = target.qr_code_url"
+            )
+            .whenNotMatchedInsertAll()
+            .whenNotMatchedBySourceDelete(condition=F.col('target.path').isin(paths))
+            .execute()
+        )
+    qr_codes.unpersist()
+
+PAGE_IMAGES_SCHEMA = pa.schema([
+    ('path', pa.string()),
+    ('page_number', pa.int32()),
+    ('resolution', pa.string()),
+    ('image_path', pa.string()),
+    ('size', pa.int64()),
+])
+
+def render_page_images(root: str):
+    # Writes every resolution of the pages of the `plan_work_units` ranges to the image store on the executors and
+    # returns one manifest row per image
+    def process(batches: Iterator[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+        for batch in batches:
+            rows = []
+            urls = batch.column('path').to_pylist()
+            page_starts = batch.column('page_start').to_pylist()
+            page_ends = batch.column('page_end').to_pylist()
+            for i, url in enumerate(urls):
+                path = url.replace('dbfs:', '')
+                try:
+                    with pymupdf.open(path) as doc:
+                        rows += list(write_page_images(
+                            doc, path, root, PAGE_IMAGE_RESOLUTIONS, PAGE_IMAGE_FORMAT, PAGE_IMAGE_QUALITY,
+                            start=page_starts[i], end=page_ends[i]
+                        ))
+                except Exception as e:
+                    # As in `chunk_pdfs`, the file keeps its current images
+                    warnings.warn(f"Exception {e} has been thrown while rendering the pages of {path}")
+                    rows.append(dict(path=path, page_number=None, resolution=None, image_path=None, size=None))
+            yield pa.RecordBatch.from_pylist(rows, schema=PAGE_IMAGES_SCHEMA)
+
+    return process
+
+def store_page_images(df: DataFrame, root: str, save_table_name: str) -> None:
+    spark.sql(f"""
+        CREATE TABLE IF NOT EXISTS {save_table_name} (
+            path STRING,
+            page_number INT,
+            resolution STRING,
+            image_path STRING,
+            size BIGINT
+        ) USING DELTA
+    """)
+
+    paths = processed_paths(df)
+    # Persisted so that the pages are rendered once for both the stale-image lookup and the merge
+    images = plan_work_units(paths).mapInArrow(render_page_images(root), PAGE_IMAGES_SCHEMA).persist()
+
+    # Pages that no longer exist in a re-published file are dropped from the manifest, together with their image files
+    failed_paths = [r.path for r in images.filter(F.col('page_number').isNull()).select('path').distinct().collect()]
+    paths = [p.replace('dbfs:', '') for p in paths if p.replace('dbfs:', '') not in failed_paths]
+    if len(paths) > 0:
+        target = DeltaTable.forName(spark, save_table_name)
+        stale_images = [
+            r.image_path for r in
+            target.toDF().filter(F.col('path').isin(paths)).join(images, on='image_path', how='left_anti').select('image_path').collect()
+        ]
+        (
+            target.alias('target').merge(
+                images.filter(F.col('path').isin(paths)).alias('source'),
+                "source.path = target.path AND source.page_number = target.page_number AND source.resolution = target.resolution"
+            )
+            .whenMatchedUpdateAll()
+            .whenNotMatchedInsertAll()
+            .whenNotMatchedBySourceDelete(condition=F.col('target.path').isin(paths))
+            .execute()
+        )
+        for image_path in stale_images:
+            try:
+                os.remove(image_path)
+            except FileNotFoundError:
+                pass
+    images.unpersist()
+
 def render_page_as_image(pdf_path: str, page_number: int, as_opencv: bool = False) -> Union[Image, np.ndarray]:
     doc = pymupdf.open(pdf_path)
     page = doc[page_number]
-    pix = page.get_pixmap(dpi=300)
-    pil_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
 
     if not as_opencv:
-        return pil_img
+        pix = page.get_pixmap(dpi=300)
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
     else:
-        return cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+        # cvtColor reads straight from the rasterizer's pixmap, so the only copy made is the BGR image itself
+        rasterizer = PageRasterizer(dpi=300)
+        return cv2.cvtColor(rasterizer.render(page), cv2.COLOR_RGB2BGR)
 
 
 
@@ -132,14 +445,12 @@ class QRCodeScraper:
     #     with open(f"export/images/{part_code}.{image_url.split('.')[-1]}", 'wb') as img_file:
     #         img_file.write(response.content)
     
-    def _process_partlist_html(self, url: str, id: int):
-        page = requests.get(url)
-        
-        if page is None or page.content is None:
-            return
-        
+    def __init__(self, cache_dir: str = None, max_workers: int = 8) -> None:
+        self.fetcher = PartListFetcher(cache_dir=cache_dir, max_workers=max_workers)
+
+    def _process_partlist_html(self, url: str, content: bytes) -> pd.DataFrame:
         # Parse the HTML content using BeautifulSoup
-        soup = BeautifulSoup(page.content, 'html.parser')
+        soup = BeautifulSoup(content, 'html.parser')
 
         # Find the table with the id 'chakra-table'
         table = soup.find('table', {'class': 'chakra-table'})
@@ -147,18 +458,12 @@ class QRCodeScraper:
         part_name = soup.select('#root > div > div.chakra-stack.css-nigbwa > div.css-1f8o5nu > div > div > div > div > div > div > div.chakra-stack.css-1humjyr > div > div > div.chakra-stack.css-1l5gd6o > div > h2.chakra-heading.css-15gvieb > div')[0].text
 
         # Parse the table using pandas
-        df = pd.read_html(str(table))[0]
+        df = pd.read_html(io.StringIO(str(table)))[0]
         df['part_code'] = part_code
         df['part_name'] = part_name
         df['qr_code_url'] = url
 
-        part_lists_df = spark.createDataFrame(df).select('item_number', 'part_number', 'designation', 'part_code', 'part_name', 'qr_code_url')
-
-        # part_lists_df = part_lists_df.withColumnRenamed('Part number', 'part_number')
-        # part_lists_df = part_lists_df.withColumnRenamed('Designation', 'designation')
-        # part_lists_df = part_lists_df.withColumnRenamed('Item', 'item_number')
-
-        return part_lists_df
+        return df[['item_number', 'part_number', 'designation', 'part_code', 'part_name', 'qr_code_url']]
     
     def _extract_qr_code_links(self, img: np.ndarray, filename: str = "", write_dir: str = None, border_size: int = 20):
         links = {}
@@ -188,7 +493,7 @@ class QRCodeScraper:
             resized_img = cv2.resize(crop_img, (224, 224))
 
             # Convert to grayscale
-            gray = cv2.cvtColor(resized_img, cv2.COLOR_BGR2GRAY)
+            gray = resized_img if resized_img.ndim == 2 else cv2.cvtColor(resized_img, cv2.COLOR_BGR2GRAY)
             
             # Add white border
             bordered_image = cv2.copyMakeBorder(
@@ -208,26 +513,62 @@ class QRCodeScraper:
 
         return links
     
-    def scrape(self, pdf_urls_in_dbx_volume: List[str], save_to_table: str = None, **kwargs) -> DataFrame:
+    def _extract_page_qr_code_links(self, page: pymupdf.Page, filename: str, prefilter: bool = True, **kwargs):
+        # With the prefilter only the candidate regions found by a cheap pass are rendered at full resolution and decoded
+        links = {}
+        for i, img in enumerate(qr_regions(page, prefilter=prefilter)):
+            links.update(self._extract_qr_code_links(img, filename='_'.join([filename, str(i)]) if prefilter else filename, **kwargs))
+        return links
+
+    def _scrape_parallel(self, pdf_urls_in_dbx_volume: List[str], workers: int, prefilter: bool = True) -> List[str]:
+        qr_code_urls = []
+        for pdf, page, url in iter_qr_codes(pdf_urls_in_dbx_volume, workers=workers, prefilter=prefilter):
+            print(f"Found QR code in pdf {pdf}, page {page+1}: {url}")
+            qr_code_urls.append(url)
+        return qr_code_urls
+
+    def scrape(self, pdf_urls_in_dbx_volume: List[str], save_to_table: str = None, prefilter: bool = True, workers: int = 1, **kwargs) -> DataFrame:
+        # With workers > 1, the pages are scanned on a process pool (see `qr_detection.iter_qr_codes`)
+        if workers > 1:
+            if kwargs.get('write_dir') is not None:
+                warnings.warn("Saving the QR code crops (write_dir) is only supported with workers=1")
+            return self.scrape_part_lists(self._scrape_parallel(pdf_urls_in_dbx_volume, workers, prefilter=prefilter), save_to_table=save_to_table)
+
         qr_code_urls = []
         for pdf in pdf_urls_in_dbx_volume:
             try:
-                nr_pages = pymupdf.open(pdf).page_count
+                doc = pymupdf.open(pdf)
             except:
                 print(f"Skipping {pdf} - an error occured while trying to open it")
-                
+                continue
+
+            nr_pages = doc.page_count
             for page in range(nr_pages):
                 print(f"Processing pdf {pdf}, page {page+1}/{nr_pages}")
                 
-                img = render_page_as_image(pdf, page_number=page, as_opencv=True)
-                links = self._extract_qr_code_links(img, filename='_'.join([pdf.split('/')[-1].replace('.pdf', ''), str(page)]), **kwargs)
-                qr_code_urls += links
+                links = self._extract_page_qr_code_links(doc[page], filename='_'.join([pdf.split('/')[-1].replace('.pdf', ''), str(page)]), prefilter=prefilter, **kwargs)
+                qr_code_urls += links.values()
+
+        return self.scrape_part_lists(qr_code_urls, save_to_table=save_to_table)
+
+    def scrape_part_lists(self, qr_code_urls: List[str], save_to_table: str = None) -> DataFrame:
+        # The same part list is often referenced from several pages
+        qr_code_urls = list(dict.fromkeys(qr_code_urls))
+
+        # Pages are fetched concurrently and all the parsed part lists become a single DataFrame
+        part_lists = []
+        for url, content in self.fetcher.fetch_all(qr_code_urls):
+            if content is None:
+                continue
+            try:
+                part_lists.append(self._process_partlist_html(url, content))
+            except Exception as e:
+                warnings.warn(f"Exception {e} has been thrown while parsing the part list at {url}")
+        print(f"Part list pages: {self.fetcher.stats}")
 
-        df = None
-        for url in qr_code_urls:
-            _df = self._process_partlist_html(url)
-            df = _df if df is None else df.union(_df)
-            # self.download_image_from_html(webpage_content, part_code)
+        if len(part_lists) == 0:
+            return None
+        df = spark.createDataFrame(pd.concat(part_lists, ignore_index=True))
 
         if save_to_table is not None:
             spark.sql(f"""
@@ -244,7 +585,7 @@ class QRCodeScraper:
             
             # Save the DataFrame merging it with the existing data
             (
-                DeltaTable.forPath(spark, save_to_table)
+                DeltaTable.forName(spark, save_to_table)
                 .alias('target').merge(
                     df
                     # .select(*cols)
@@ -20,6 +20,14 @@ Chat history: {chat_history}
 Question: {question}
 """
 
+# Prompt sent by the Dash UI when a conversation is started from the dropdowns (dash_ui/services.build_string_input).
+# Answers to these prompts are precomputed, so both must produce the same text up to whitespace.
+STRUCTURED_PROMPT_TEMPLATE = """
+    Give me assistance to {maintenance_type} part {qr_code_part} from BPW on a trailer.
+    When returning the final answer with tools, parts list and steps, combine it with all the information you have on the following items:
+    {part_list_bullet_points}
+    """
+
 CHUNK_TEMPLATE = "Passage: {chunk_text}\nSource: Page {page_nr} from {document_uri}\n"
 
 OUTPUT_REWRITE_WITH_HISTORY_TEMPLATE = """
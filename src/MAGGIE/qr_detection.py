@@ -0,0 +1,127 @@
+import cv2
+import multiprocessing
+import numpy as np
+import os
+import pymupdf
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Tuple
+from .rendering import PageRasterizer
+
+QR_RENDER_DPI = 300
+QR_PREFILTER_DPI = 100
+QR_MIN_PATH_ITEMS = 50
+QR_CANDIDATE_PADDING = 12 # in PDF points, so that the quiet zone around the code is rendered too
+QR_PAGES_PER_TASK = 8
+
+
+def decode_qr_codes(img: np.ndarray) -> List[str]:
+    is_qr_detected, decoded_info, points, straight_qrcode = cv2.QRCodeDetector().detectAndDecodeMulti(img)
+    if points is None:
+        return []
+    return [info.strip() for info in decoded_info if info]
+
+
+def _merge_overlapping(rects: List[pymupdf.Rect]) -> List[pymupdf.Rect]:
+    # Repeated until no two regions overlap: a merged region can reach one that neither of its parts overlapped,
+    # and two regions covering the same QR code would decode it twice
+    merged = list(rects)
+    while True:
+        regions = []
+        for rect in merged:
+            for i, other in enumerate(regions):
+                if rect.intersects(other):
+                    regions[i] = other | rect
+                    break
+            else:
+                regions.append(rect)
+        if len(regions) == len(merged):
+            return regions
+        merged = regions
+
+
+def find_qr_candidates(page: pymupdf.Page, dpi: int = QR_PREFILTER_DPI, padding: float = QR_CANDIDATE_PADDING) -> List[pymupdf.Rect]:
+    candidates = []
+
+    # Embedded raster images with a roughly square placement
+    for info in page.get_image_info():
+        rect = pymupdf.Rect(info['bbox'])
+        if rect.width > 20 and rect.height > 20 and 0.8 < rect.width / rect.height < 1.25:
+            candidates.append(rect)
+
+    # Vector graphics: a drawn QR code is a path made of many small filled squares
+    for drawing in page.get_drawings():
+        rect = drawing['rect']
+        if len(drawing['items']) >= QR_MIN_PATH_ITEMS and rect.width > 20 and 0.8 < rect.width / max(rect.height, 1e-6) < 1.25:
+            candidates.append(rect)
+
+    # Cheap low-DPI grayscale pass for anything else (e.g. a code inside a larger picture): detection only, no decoding
+    rasterizer = PageRasterizer(dpi=dpi, grayscale=True)
+    img = rasterizer.render(page)
+    is_qr_detected, points = cv2.QRCodeDetector().detectMulti(img)
+    if is_qr_detected and points is not None:
+        scale = 72 / dpi
+        for p in points:
+            (x0, y0), (x1, y1) = p.min(axis=0) * scale, p.max(axis=0) * scale
+            candidates.append(pymupdf.Rect(x0, y0, x1, y1))
+
+    padded = [pymupdf.Rect(r.x0 - padding, r.y0 - padding, r.x1 + padding, r.y1 + padding) & page.rect for r in candidates]
+    return _merge_overlapping(padded)
+
+
+def qr_regions(page: pymupdf.Page, prefilter: bool = True, dpi: int = QR_RENDER_DPI) -> Iterator[np.ndarray]:
+    # Grayscale images worth decoding: the full page without prefilter, otherwise only the clipped candidate regions.
+    # Every image is a view into the rasterizer's pixmap, valid until the next one is yielded.
+    rasterizer = PageRasterizer(dpi=dpi, grayscale=True)
+    if not prefilter:
+        yield rasterizer.render(page)
+        return
+    for rect in find_qr_candidates(page):
+        yield rasterizer.render(page, clip=rect)
+
+
+def scan_document(doc: pymupdf.Document, start: int = 0, end: int = None, prefilter: bool = True) -> Iterator[Tuple[int, List[str]]]:
+    end = doc.page_count if end is None else min(end, doc.page_count)
+    for page_number in range(start, end):
+        urls = []
+        for img in qr_regions(doc[page_number], prefilter=prefilter):
+            urls += decode_qr_codes(img)
+        yield page_number, urls
+
+
+def scan_page_range(pdf_path: str, start: int, end: int, prefilter: bool = True) -> List[Tuple[int, List[str]]]:
+    with pymupdf.open(pdf_path) as doc:
+        return list(scan_document(doc, start, end, prefilter=prefilter))
+
+
+def iter_qr_codes(pdf_paths: List[str], workers: int = None, prefilter: bool = True, pages_per_task: int = QR_PAGES_PER_TASK) -> Iterator[Tuple[str, int, str]]:
+    # The pages of all the documents are scanned in small ranges on a process pool, at most two ranges per worker
+    # in flight, and every (pdf, page, url) is yielded as soon as the range it belongs to has been scanned
+    def tasks():
+        for pdf in pdf_paths:
+            try:
+                with pymupdf.open(pdf) as doc:
+                    nr_pages = doc.page_count
+            except Exception:
+                print(f"Skipping {pdf} - an error occured while trying to open it")
+                continue
+            for start in range(0, nr_pages, pages_per_task):
+                yield pdf, start, min(start + pages_per_task, nr_pages)
+
+    def completed():
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pdf = pending.pop(future)
+            for page_number, urls in future.result():
+                for url in urls:
+                    yield pdf, page_number, url
+
+    workers = workers or os.cpu_count()
+    pending = {}
+    # Spawned workers only import this module, not the Spark session living in the driver process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for pdf, start, end in tasks():
+            if len(pending) >= 2 * workers:
+                yield from completed()
+            pending[executor.submit(scan_page_range, pdf, start, end, prefilter)] = pdf
+        while len(pending) > 0:
+            yield from completed()
@@ -0,0 +1,57 @@
+import numpy as np
+import pymupdf
+from pymupdf import mupdf
+
+
+class PageRasterizer:
+    # Renders pages straight into a pixmap owned by the rasterizer and exposes its samples as a NumPy view, without
+    # going through PIL or any intermediate copy. With `reuse_buffer` the same pixmap is drawn into again whenever the
+    # next page (or clip) has the same pixel size, which is the common case when rendering the pages of a manual.
+    #
+    # The array returned by `render` points into that pixmap: it is only valid until the next call to `render` and as
+    # long as the rasterizer itself is alive, so don't render with a temporary rasterizer. Pass `copy=True` to keep an
+    # image around.
+    def __init__(self, dpi: int = 300, grayscale: bool = False, reuse_buffer: bool = True) -> None:
+        self.dpi = dpi
+        self.grayscale = grayscale
+        self.reuse_buffer = reuse_buffer
+        self.pixmap = None
+        self.allocations = 0
+
+    def _target(self, irect: pymupdf.IRect, grayscale: bool) -> pymupdf.Pixmap:
+        n = 1 if grayscale else 3
+        reusable = (
+            self.reuse_buffer
+            and self.pixmap is not None
+            and self.pixmap.irect == irect
+            and self.pixmap.n == n
+        )
+        if not reusable:
+            # Device colorspaces: drawing into pymupdf.csRGB/csGRAY goes through a colour conversion for every object
+            # and is several times slower than Page.get_pixmap
+            colorspace = mupdf.fz_device_gray() if grayscale else mupdf.fz_device_rgb()
+            pixmap = mupdf.fz_new_pixmap_with_bbox(colorspace, mupdf.FzIrect(*irect), mupdf.FzSeparations(), 0)
+            self.pixmap = pymupdf.Pixmap('raw', pixmap)
+            self.allocations += 1
+        mupdf.fz_clear_pixmap_with_value(self.pixmap.this, 255)
+        return self.pixmap
+
+    def render(self, page: pymupdf.Page, clip: pymupdf.Rect = None, dpi: int = None, grayscale: bool = None, copy: bool = False) -> np.ndarray:
+        dpi = self.dpi if dpi is None else dpi
+        grayscale = self.grayscale if grayscale is None else grayscale
+
+        zoom = dpi / 72
+        matrix = pymupdf.Matrix(zoom, zoom)
+        rect = page.rect if clip is None else page.rect & clip
+        pixmap = self._target((rect * matrix).irect, grayscale)
+
+        # Same drawing steps as Page.get_pixmap, but into our own pixmap: the draw device only touches the pixels
+        # covered by the pixmap, so a clip costs no more than its own area
+        device = mupdf.fz_new_draw_device(mupdf.FzMatrix(*matrix), pixmap.this)
+        mupdf.fz_run_page(page.this, device, mupdf.FzMatrix(), mupdf.FzCookie())
+        mupdf.fz_close_device(device)
+
+        img = np.frombuffer(pixmap.samples_mv, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+        if grayscale:
+            img = img[..., 0]
+        return img.copy() if copy else img
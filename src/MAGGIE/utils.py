@@ -29,6 +29,18 @@ MAX_TOKENS = 1500
 TEMPERATURE = 0.01
 TOP_K = 3
 SIMILARITY_QUERY_TYPE = "ann"
+CONTEXT_MAX_TOKENS = 3000 # budget of the retrieved chunks in the prompt, after de-duplication
+CONTEXT_TOKENIZER_ENCODING = 'cl100k_base' # tiktoken encoding used to count the tokens of the context
+CONTEXT_NEAR_DUPLICATE_THRESHOLD = 0.9 # Jaccard similarity of the words of two chunks above which only one is kept
+EMBEDDING_MAX_BATCH_SIZE = 150 # the embedding endpoint takes at most 150 inputs per request
+EMBEDDING_MAX_BATCH_TOKENS = 32000
+EMBEDDING_CONCURRENCY = 4 # concurrent requests per executor
+PAGES_PER_WORK_UNIT = 50 # large manuals are split into page ranges processed by different tasks
+CHUNKS_PER_OUTPUT_BATCH = 500 # bounds the chunks (and embedding requests) buffered before being emitted
+
+# Text extraction engine used at ingest (see `extraction.PDF_ENGINES` and benchmarks/pdf_engines_benchmark.py).
+# Switching engine changes the extracted text, hence every page fingerprint: the next run re-chunks and re-embeds everything.
+PDF_ENGINE = 'pypdf'
 
 PARSERS = {
     'sentence': SentenceSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP),
@@ -59,11 +71,56 @@ PDF_NAMES = [path.replace('.pdf', '') for path in PDF_PATHS]
 
 RAW_PDF_TABLE = 'hackathon_pdf_raw'
 CLEAN_PDF_TABLE = 'hackathon_pdf_chunks'
+EMBEDDING_CACHE_TABLE = 'hackathon_embedding_cache'
+QR_CODES_TABLE = 'hackathon_qr_codes'
+PAGE_IMAGES_TABLE = 'hackathon_page_images'
+PRECOMPUTED_ANSWERS_TABLE = 'hackathon_precomputed_answers'
 VOLUME_NAME = 'volume_hackathon' 
 PDFS_FOLDER = 'pdfs'
 
 QR_CODES_DIR = './qr_codes'
 PARTS_LIST_TABLE = 'part_lists'
+PARTS_LIST_CACHE_FOLDER = 'part_list_pages' # HTML cache of the part list pages, inside the volume
+
+PAGE_IMAGES_FOLDER = 'page_images' # pre-rendered page images served with the references, inside the volume
+PAGE_IMAGE_RESOLUTIONS = {'thumbnail': 36, 'full': 300} # name -> DPI, 'full' as rendered by the chain when a page is missing
+PAGE_IMAGE_FORMAT = 'webp' # or 'jpeg', faster to encode but ~1.7x larger
+PAGE_IMAGE_QUALITY = 80
+PDF_CACHE_MB = 512 # per serving replica, for the PDFs of the pages missing from the image store
+PAGE_IMAGE_CACHE_MB = 256 # per serving replica
+REFERENCE_RENDER_WORKERS = 8 # per serving replica, shared by all requests
+RETRIEVAL_CONCURRENT_REQUESTS = 16 # synchronous requests a replica retrieves for at once, with 3 concurrent searches each
+REFERENCE_TIME_BUDGET_SECONDS = 5 # pages not ready by then are answered with a placeholder image
+# 'inline': every reference carries its page as a base64 image. 'lazy': references only carry a `reference_id`,
+# the images are fetched on demand from the page image store (see dash_ui/services/databricks_service.py). This is the
+# default, a request can ask for the other one with "reference_mode" (the Dash UI asks for 'lazy' references).
+REFERENCE_MODE = 'inline'
+QUERY_CACHE_ENTRIES = 2048 # per serving replica, for both the query embeddings and the retrieved documents
+QUERY_CACHE_TTL_SECONDS = 6 * 3600
+INDEX_VERSION_REFRESH_SECONDS = 60 # how often serving checks whether the index has been synced
+ANSWER_CACHE_ENTRIES = 512 # per serving replica
+ANSWER_CACHE_MB = 256 # per serving replica: an answer with inline references carries its page images
+ANSWER_CACHE_TTL_SECONDS = 24 * 3600
+# Cosine similarity between question embeddings above which a cached answer is returned. Kept high on purpose:
+# "install X" and "remove X" are close in embedding space but need different answers.
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.97
+
+# Answers precomputed after each ingest for the prompts of the Dash UI dropdowns (see precompute.py)
+MAINTENANCE_TYPES = ['install', 'repair', 'remove']
+MAX_PRECOMPUTED_PROMPTS = 1500
+PRECOMPUTE_WORKERS = 8
+PRECOMPUTED_ANSWERS_FILE = 'precomputed_answers.json' # snapshot read by the serving chain, inside the volume
+PRECOMPUTED_ANSWERS_REFRESH_SECONDS = 300
+
+# Async serving path (`chain.ainvoke`), per serving replica
+ASYNC_MAX_CONCURRENT_REQUESTS = 64 # requests in flight, the others wait for a slot
+ASYNC_MAX_CONNECTIONS = 100 # HTTP connections to the workspace APIs
+ASYNC_TIMEOUT_SECONDS = 120
+
+# Latency percentiles per stage of the chain (see chain.get_stage_timings), dumped by every replica into the volume
+STAGE_TIMINGS_FOLDER = 'stage_timings'
+STAGE_TIMINGS_DUMP_SECONDS = 300
+STAGE_TIMINGS_IN_RESPONSE = False # requests can still ask for them with "return_timings": true
 
 VECTOR_SEARCH_ENDPOINT_NAME = "rag_endpoint"
 VS_PRIMARY_KEY = "id"
@@ -74,14 +131,28 @@ FEC = FeatureEngineeringClient()
 CATALOG_NAME = "test-catalog"
 SCHEMA_NAME = "bronze"
 TABLE_PATH = "{}.{}.".format(CATALOG_NAME, SCHEMA_NAME) + "{table_name}"
+PAGE_IMAGES_PATH = f"/Volumes/{CATALOG_NAME}/{SCHEMA_NAME}/{VOLUME_NAME}/{PAGE_IMAGES_FOLDER}"
+PRECOMPUTED_ANSWERS_PATH = f"/Volumes/{CATALOG_NAME}/{SCHEMA_NAME}/{VOLUME_NAME}/{PRECOMPUTED_ANSWERS_FILE}"
+STAGE_TIMINGS_PATH = f"/Volumes/{CATALOG_NAME}/{SCHEMA_NAME}/{VOLUME_NAME}/{STAGE_TIMINGS_FOLDER}"
 
 VS_INDEX_FULLNAME = TABLE_PATH.format(table_name="hackathon_pdfs_self_managed_vs_index") # Where we want to store our index
 PDFS_TABLE_FULLNAME = TABLE_PATH.format(table_name=CLEAN_PDF_TABLE) # Table containing the PDF's chunks
 
 CHAIN_CONFIG_FILE = "rag_chain_config.yaml"
 MODEL_SCRIPT_PATH = os.path.join(os.getcwd(), "chain.py")
+MODEL_CODE_PATHS = [os.path.join(os.getcwd(), "page_store.py")] # modules chain.py imports, logged next to it
+MODEL_PIP_REQUIREMENTS = ["httpx==0.27.2"] # imported unconditionally by chain.py: pinned in the serving environment, next to the inferred ones
 
 MODEL_NAME = "maggie"
+# The chain reads the page image store through the Files API with these credentials. When a scaled-to-zero endpoint
+# starts, it opens its connections in the background ("connections"), or also answers a synthetic question ("query").
+# Its replicas also dump their stage timings to STAGE_TIMINGS_PATH.
+SERVING_ENVIRONMENT_VARS = {
+    "DATABRICKS_HOST": "{{secrets/maggie/databricks_host}}",
+    "DATABRICKS_TOKEN": "{{secrets/maggie/databricks_token}}",
+    "MAGGIE_WARM_UP": "connections",
+    "MAGGIE_STAGE_TIMINGS_SINK": "on",
+}
 
 EMBEDDING_MODEL = "databricks-gte-large-en"
 CHAT_MODEL = "databricks-meta-llama-3-1-70b-instruct"
@@ -124,5 +195,16 @@ RAG_CONFIG = {
         "schema": {"chunk_text": "content", "document_uri": "url", "primary_key": "id", "page_nr": "page_number"}, # the keys need to match CHUNK_TEMPLATE's variables
         "vector_search_index": VS_INDEX_FULLNAME,
         "uri_prefix": BASE_URL,
+        "page_images": {"root": PAGE_IMAGES_PATH, "resolution": "full", "format": PAGE_IMAGE_FORMAT}, # see page_images.page_image_path
+        "image_cache": {"max_pdf_mb": PDF_CACHE_MB, "max_page_image_mb": PAGE_IMAGE_CACHE_MB},
+        "reference_images": {"max_workers": REFERENCE_RENDER_WORKERS, "time_budget_seconds": REFERENCE_TIME_BUDGET_SECONDS},
+        "retrieval": {"max_concurrent_requests": RETRIEVAL_CONCURRENT_REQUESTS},
+        "reference_mode": REFERENCE_MODE,
+        "query_cache": {"max_entries": QUERY_CACHE_ENTRIES, "ttl_seconds": QUERY_CACHE_TTL_SECONDS, "index_version_refresh_seconds": INDEX_VERSION_REFRESH_SECONDS},
+        "precomputed_answers": {"path": PRECOMPUTED_ANSWERS_PATH, "refresh_seconds": PRECOMPUTED_ANSWERS_REFRESH_SECONDS},
+        "answer_cache": {"enabled": True, "max_entries": ANSWER_CACHE_ENTRIES, "max_mb": ANSWER_CACHE_MB, "ttl_seconds": ANSWER_CACHE_TTL_SECONDS, "similarity_threshold": ANSWER_CACHE_SIMILARITY_THRESHOLD},
+        "async_serving": {"max_concurrent_requests": ASYNC_MAX_CONCURRENT_REQUESTS, "max_connections": ASYNC_MAX_CONNECTIONS, "timeout_seconds": ASYNC_TIMEOUT_SECONDS},
+        "context": {"max_tokens": CONTEXT_MAX_TOKENS, "encoding": CONTEXT_TOKENIZER_ENCODING, "near_duplicate_threshold": CONTEXT_NEAR_DUPLICATE_THRESHOLD},
+        "stage_timings": {"include_in_response": STAGE_TIMINGS_IN_RESPONSE, "sink_path": STAGE_TIMINGS_PATH, "dump_interval_seconds": STAGE_TIMINGS_DUMP_SECONDS},
     },
 }
\ No newline at end of file
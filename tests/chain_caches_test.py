@@ -0,0 +1,206 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import hashlib
+import io
+import json
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+QUESTION = {"messages": [{"role": "user", "content": "How do I replace the brake pads?"}]}
+
+
+def test_byte_size_cache_loads_concurrent_misses_once(load_chain):
+    cache = load_chain().ByteSizeLRUCache(max_bytes=1024)
+    loads = []
+    started = threading.Event()
+
+    def loader():
+        loads.append(1)
+        started.set()
+        time.sleep(0.2)
+        return b"page"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        owner = executor.submit(cache.get_or_load, "manual.pdf", loader)
+        started.wait()
+        waiters = [executor.submit(cache.get_or_load, "manual.pdf", loader) for _ in range(3)]
+        values = [f.result() for f in [owner, *waiters]]
+
+    assert values == [b"page"] * 4 and len(loads) == 1
+    assert cache.get_or_load("manual.pdf", loader) == b"page"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["coalesced"]) == (1, 1, 3)
+    # The waiters shared the load but weren't served from the cache
+    assert stats["hit_rate"] == 1 / 5
+
+
+def test_byte_size_cache_evicts_least_recently_used_bytes(load_chain):
+    cache = load_chain().ByteSizeLRUCache(max_bytes=10)
+    cache.get_or_load("a", lambda: b"aaaa")
+    cache.get_or_load("b", lambda: b"bbbb")
+    cache.get_or_load("a", lambda: b"aaaa")
+
+    cache.get_or_load("c", lambda: b"cccc")
+
+    assert list(cache._entries) == ["a", "c"]
+    assert cache.stats()["bytes"] == 8 and cache.stats()["evictions"] == 1
+
+    # Larger than the whole cache: served, not kept, nothing evicted for it
+    assert cache.get_or_load("d", lambda: b"d" * 11) == b"d" * 11
+    assert list(cache._entries) == ["a", "c"] and cache.stats()["evictions"] == 1
+
+
+def test_retrieval_is_reused_until_the_index_version_changes(load_chain, monkeypatch):
+    import fake_databricks
+    chain = load_chain()
+    searches = []
+    search = fake_databricks.FakeVectorSearch.similarity_search_by_vector
+    monkeypatch.setattr(fake_databricks.FakeVectorSearch, "similarity_search_by_vector", lambda self, *args, **kwargs: searches.append(1) or search(self, *args, **kwargs))
+    query_vector = [0.1] * 16
+
+    docs = chain.search_by_vector(query_vector)
+    assert chain.search_by_vector(query_vector) == docs and len(searches) == 1
+    assert chain.retrieval_cache_key(query_vector, 1) == chain.retrieval_cache_key(list(query_vector), 1)
+    assert chain.retrieval_cache_key(query_vector, 1) != chain.retrieval_cache_key([0.2] * 16, 1)
+
+    # A newer index version, once it's been checked, is another key and empties the cache
+    monkeypatch.setattr(fake_databricks.FakeIndex, "describe", lambda self: {"status": {"triggered_update_status": {"last_processed_commit_version": 2}}})
+    chain.index_version["checked_at"] = None
+    chain.search_by_vector(query_vector)
+    assert len(searches) == 2 and chain.retrieval_cache.stats()["entries"] == 1
+    assert chain.retrieval_cache_key(query_vector, 1) != chain.retrieval_cache_key(query_vector, 2)
+
+
+def unit_vector(*components) -> list:
+    return list(components) + [0.] * (16 - len(components))
+
+
+def test_answer_cache_serves_paraphrases_above_the_similarity_threshold(load_chain):
+    cache = load_chain().SemanticAnswerCache(max_entries=10, max_bytes=1024, ttl_seconds=3600, similarity_threshold=0.97)
+    cache.put("How do I replace the brake pads?", unit_vector(1.), "history", 1, "answer")
+
+    # cos = 0.98 and 0.96: a paraphrase, then a different question
+    assert cache.lookup(unit_vector(0.98, (1 - 0.98 ** 2) ** 0.5), "history", 1) == "answer"
+    assert cache.lookup(unit_vector(0.96, (1 - 0.96 ** 2) ** 0.5), "history", 1) is None
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+
+def test_answer_cache_is_isolated_per_history_and_index_version(load_chain):
+    cache = load_chain().SemanticAnswerCache(max_entries=10, max_bytes=1024, ttl_seconds=3600, similarity_threshold=0.97)
+    cache.put("And on the second axle?", unit_vector(1.), "brake pads history", 1, "brake pads answer")
+
+    assert cache.lookup(unit_vector(1.), "brake pads history", 1) == "brake pads answer"
+    assert cache.lookup(unit_vector(1.), "wheel bearing history", 1) is None
+    assert cache.lookup(unit_vector(1.), "brake pads history", 2) is None
+
+
+def test_cached_answers_are_dropped_when_the_index_version_changes(load_chain, monkeypatch):
+    import fake_databricks
+    chain = load_chain()
+    monkeypatch.setattr(chain, "load_page_image", lambda url, page_number, pdf_path: b"page")
+    chain.chain.invoke(QUESTION)
+    assert chain.answer_cache.stats()["entries"] == 1
+
+    monkeypatch.setattr(fake_databricks.FakeIndex, "describe", lambda self: {"status": {"triggered_update_status": {"last_processed_commit_version": 2}}})
+    chain.index_version["checked_at"] = None
+    chain.chain.invoke(QUESTION)
+
+    stats = chain.answer_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (0, 2, 1)
+
+
+def test_answers_with_placeholder_images_are_not_cached(load_chain, monkeypatch):
+    chain = load_chain()
+
+    def load_page_image(url, page_number, pdf_path):
+        raise FileNotFoundError(pdf_path)
+    monkeypatch.setattr(chain, "load_page_image", load_page_image)
+
+    response = json.loads(chain.chain.invoke(QUESTION))
+
+    assert all(r["img_base64"] == chain.placeholder_image for r in response["references"])
+    assert chain.answer_cache.stats()["entries"] == 0
+
+
+def serve_snapshot(monkeypatch, snapshot: dict, downloaded: threading.Event = None):
+    import fake_databricks
+
+    def download(self, path):
+        if downloaded is not None:
+            downloaded.wait()
+        return types.SimpleNamespace(contents=io.BytesIO(json.dumps(snapshot).encode("utf-8")))
+    monkeypatch.setattr(fake_databricks.FakeFiles, "download", download)
+
+
+def snapshot_of(chain, question: str, answer: str, index_version: str, reference_mode: str = "lazy") -> dict:
+    fingerprint = hashlib.sha256(chain.normalize_query(question).encode("utf-8")).hexdigest()
+    return {"index_version": index_version, "reference_mode": reference_mode, "answers": {fingerprint: answer}}
+
+
+def test_precomputed_answers_match_the_index_version_and_reference_mode(load_chain, monkeypatch):
+    chain = load_chain()
+    serve_snapshot(monkeypatch, snapshot_of(chain, "How do I replace the brake pads?", "answer", "1"))
+
+    assert chain.get_precomputed_answer("how do I  replace the brake pads?", 1, "lazy") == "answer"
+    assert chain.get_precomputed_answer("How do I replace the brake pads?", 1, "inline") is None
+    assert chain.get_precomputed_answer("How do I replace the brake pads?", 2, "lazy") is None
+
+
+def test_unknown_index_version_never_matches_a_precomputed_answer(load_chain, monkeypatch):
+    chain = load_chain()
+    serve_snapshot(monkeypatch, snapshot_of(chain, "How do I replace the brake pads?", "answer", "None"))
+
+    assert chain.get_precomputed_answer("How do I replace the brake pads?", None, "lazy") is None
+
+
+def test_precomputed_answers_are_served_while_a_new_snapshot_downloads(load_chain, monkeypatch):
+    chain = load_chain()
+    downloaded = threading.Event()
+    serve_snapshot(monkeypatch, snapshot_of(chain, "How do I replace the brake pads?", "answer", "1"), downloaded)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        loading = executor.submit(chain.get_precomputed_answer, "How do I replace the brake pads?", 1, "lazy")
+        time.sleep(0.2)
+        # The download doesn't hold the lock: this request isn't kept waiting, it misses on the current (empty) snapshot
+        assert chain.get_precomputed_answer("How do I replace the brake pads?", 1, "lazy") is None and not loading.done()
+        downloaded.set()
+        assert loading.result() == "answer"
+    assert chain.get_precomputed_answer("How do I replace the brake pads?", 1, "lazy") == "answer"
+
+
+def test_answer_cache_evicts_least_recently_used_bytes(load_chain):
+    cache = load_chain().SemanticAnswerCache(max_entries=10, max_bytes=10, ttl_seconds=3600, similarity_threshold=0.97)
+    cache.put("a", unit_vector(1.), "history", 1, "aaaa")
+    cache.put("b", unit_vector(0., 1.), "history", 1, "bbbb")
+    assert cache.lookup(unit_vector(1.), "history", 1) == "aaaa"
+
+    cache.put("c", unit_vector(0., 0., 1.), "history", 1, "cccc")
+
+    assert cache.lookup(unit_vector(0., 1.), "history", 1) is None
+    assert (cache.stats()["entries"], cache.stats()["bytes"], cache.stats()["evictions"]) == (2, 8, 1)
+
+    # Larger than the whole cache: not kept, nothing evicted for it
+    cache.put("d", unit_vector(0., 0., 0., 1.), "history", 1, "d" * 11)
+    assert (cache.stats()["entries"], cache.stats()["bytes"], cache.stats()["evictions"]) == (2, 8, 1)
+
+
+def test_queries_are_embedded_as_asked_and_cached_by_their_normalized_text(load_chain):
+    from fake_databricks import FakeEmbeddings
+
+    class RecordingEmbeddings(FakeEmbeddings):
+        requests: list = []
+
+        def embed_documents(self, texts):
+            self.requests.append(texts)
+            return super().embed_documents(texts)
+
+    embeddings = RecordingEmbeddings(size=16)
+    chain = load_chain(embeddings=embeddings)
+
+    vectors = chain.embed_queries(["How do I  Replace the brake pads?", "how do i replace the brake pads?"])
+    assert chain.embed_queries(["HOW DO I REPLACE THE BRAKE PADS?"]) == [vectors[0]]
+
+    assert embeddings.requests == [["How do I  Replace the brake pads?"]] and vectors[0] == vectors[1]
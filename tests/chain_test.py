@@ -0,0 +1,232 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import asyncio
+import base64
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage
+from fake_databricks import ANSWER, FakeChatModel, FakeEmbeddings, fake_backend_transport
+
+QUESTION = {"messages": [{"role": "user", "content": "How do I replace the brake pads?"}]}
+
+
+def test_invoke_returns_answer_and_references(load_chain, monkeypatch):
+    chain = load_chain()
+    monkeypatch.setattr(chain, "load_page_image", lambda url, page_number, pdf_path: b"page")
+
+    response = json.loads(chain.chain.invoke(QUESTION))
+
+    assert response["answer"] == ANSWER
+    # Three retrievals of the same three chunks: one reference per (document, page)
+    assert [r["page_number"] for r in response["references"]] == [1, 2, 3]
+    assert all(r["img_base64"] == base64.b64encode(b"page").decode() for r in response["references"])
+
+
+def test_lazy_references_are_opted_into_per_request(load_chain):
+    chain = load_chain().chain
+    chain.invoke(QUESTION)
+
+    response = json.loads(chain.invoke({**QUESTION, "reference_mode": "lazy"}))
+
+    # Not served from the inline answer cached by the first request
+    assert all("reference_id" in r and "img_base64" not in r for r in response["references"])
+
+
+def test_one_rewrite_and_one_embedding_request_for_the_three_queries(load_chain):
+    class RecordingChatModel(FakeChatModel):
+        prompts: list = []
+
+        def _generate(self, messages, *args, **kwargs):
+            self.prompts.append(" ".join(m.content for m in messages))
+            return super()._generate(messages, *args, **kwargs)
+
+    class RecordingEmbeddings(FakeEmbeddings):
+        requests: list = []
+
+        def embed_documents(self, texts):
+            self.requests.append(texts)
+            return super().embed_documents(texts)
+
+    model = RecordingChatModel(messages=itertools.cycle([AIMessage(content=ANSWER)]))
+    embeddings = RecordingEmbeddings(size=16)
+    chain = load_chain(retriever_config={"answer_cache": {"enabled": False}}, chat_model=model, embeddings=embeddings)
+    follow_up = {"messages": [
+        {"role": "user", "content": "How do I replace the brake pads?"},
+        {"role": "assistant", "content": ANSWER},
+        {"role": "user", "content": "And on the second axle?"},
+    ], "reference_mode": "lazy"}
+
+    chain.chain.invoke(follow_up)
+
+    # The main, parts and tools queries all derive from a single rewrite of the follow-up question
+    assert len([p for p in model.prompts if p.startswith("Chat history:")]) == 1
+    assert len(embeddings.requests) == 1 and len(embeddings.requests[0]) == 3
+
+
+def test_stream_yields_tokens_then_references(load_chain):
+    model = FakeChatModel(messages=itertools.cycle([AIMessage(content=ANSWER)]), token_delay=0.05)
+    chain = load_chain(chat_model=model).chain
+
+    start = time.perf_counter()
+    events = []
+    for event in chain.stream(QUESTION):
+        if len(events) == 0:
+            time_to_first_token = time.perf_counter() - start
+        events.append(json.loads(event))
+    elapsed = time.perf_counter() - start
+
+    assert [e["type"] for e in events[:-1]] == ["token"] * (len(events) - 1)
+    assert "".join(e["content"] for e in events[:-1]) == ANSWER
+    assert events[-1]["type"] == "references" and len(events[-1]["references"]) == 3
+    assert time_to_first_token < elapsed / 4
+
+
+def test_cached_answer_is_streamed_as_a_single_token(load_chain, monkeypatch):
+    chain = load_chain()
+    monkeypatch.setattr(chain, "load_page_image", lambda url, page_number, pdf_path: b"page")
+    chain.chain.invoke(QUESTION)
+
+    events = [json.loads(e) for e in chain.chain.stream(QUESTION)]
+
+    assert [e["type"] for e in events] == ["token", "references"]
+    assert events[0]["content"] == ANSWER
+
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_references_are_rendered_while_the_answer_is_generated(load_chain, monkeypatch, stream):
+    # LLM and page images take `delay` each: run one after the other, the request would take twice as long
+    delay = 0.5
+    model = FakeChatModel(messages=itertools.cycle([AIMessage(content=ANSWER)]), latency=delay)
+    chain = load_chain(retriever_config={"answer_cache": {"enabled": False}}, chat_model=model)
+
+    def load_page_image(url, page_number, pdf_path):
+        time.sleep(delay)
+        return b"page"
+    monkeypatch.setattr(chain, "load_page_image", load_page_image)
+
+    start = time.perf_counter()
+    if stream:
+        references = [json.loads(e) for e in chain.chain.stream(QUESTION)][-1]["references"]
+    else:
+        references = json.loads(chain.chain.invoke(QUESTION))["references"]
+    elapsed = time.perf_counter() - start
+
+    assert [r["img_base64"] for r in references] == [base64.b64encode(b"page").decode()] * 3
+    assert elapsed < 1.5 * delay
+
+
+def test_resources_are_created_on_warm_up(load_chain):
+    chain = load_chain()
+    assert not any(r.is_ready() for r in [chain.vs_index, chain.embedding_model, chain.vector_search, chain.chat_model])
+
+    timings = chain.warm_up(run_query=True)
+
+    assert all(r.is_ready() for r in [chain.vs_index, chain.embedding_model, chain.vector_search, chain.chat_model])
+    assert {"imports", "config", "vector_search_index", "embedding_model", "chat_model", "warm_up", "warm_up_query"} <= set(timings)
+
+
+def test_ainvoke_returns_the_same_response_as_invoke(load_chain):
+    chain = load_chain(retriever_config={"answer_cache": {"enabled": False}})
+    chain.async_databricks.transport = fake_backend_transport()
+
+    assert json.loads(asyncio.run(chain.chain.ainvoke(QUESTION))) == json.loads(chain.chain.invoke(QUESTION))
+
+
+def test_ainvoke_limits_the_concurrent_requests(load_chain):
+    # A request makes 3 backend calls one after the other (embeddings, retrievals, LLM): 4 requests, 2 at a time,
+    # take about two request durations. Questions differ so that no embedding or retrieval is cached.
+    latency = 0.05
+    chain = load_chain(retriever_config={"answer_cache": {"enabled": False}, "async_serving": {"max_concurrent_requests": 2, "max_connections": 10, "timeout_seconds": 10}})
+    chain.async_databricks.transport = fake_backend_transport(latency)
+    questions = ({"messages": [{"role": "user", "content": f"How do I replace the brake pads of axle {i}?"}]} for i in itertools.count())
+
+    async def run(nr_requests):
+        start = time.perf_counter()
+        await asyncio.gather(*[chain.chain.ainvoke(next(questions)) for _ in range(nr_requests)])
+        return time.perf_counter() - start
+
+    asyncio.run(run(1))  # warm up
+    single, limited = asyncio.run(run(1)), asyncio.run(run(4))
+    assert 1.5 * single < limited < 3 * single
+
+
+def test_concurrent_requests_search_in_parallel(load_chain, monkeypatch):
+    # Each request searches its 3 queries at once: 2 concurrent requests take as long as one, they don't queue
+    # behind each other's searches
+    import fake_databricks
+    latency = 0.5
+    chain = load_chain(retriever_config={"answer_cache": {"enabled": False}, "retrieval": {"max_concurrent_requests": 2}})
+    questions = [{"messages": [{"role": "user", "content": f"How do I replace the brake pads of axle {i}?"}], "reference_mode": "lazy"} for i in range(3)]
+    chain.chain.invoke(questions[0])  # warm up
+    monkeypatch.setattr(fake_databricks.FakeVectorSearch, "latency", latency)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(chain.chain.invoke, questions[1:]))
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 1.5 * latency
+
+
+def test_stage_timings(load_chain, tmp_path):
+    chain = load_chain(retriever_config={"answer_cache": {"enabled": False}})
+    question = {**QUESTION, "return_timings": True}
+    stages = {"input_parsing", "embedding", "retrieval_main", "retrieval_parts", "retrieval_tools", "prompt_assembly", "llm", "references", "total"}
+
+    timings = json.loads(chain.chain.invoke(question))["timings"]
+    # Nothing is streamed: the first token comes with the whole answer
+    assert stages <= set(timings) and "llm_first_token" not in timings
+    assert "timings" not in json.loads(chain.chain.invoke(QUESTION))
+    events = [json.loads(e) for e in chain.chain.stream(question)]
+    assert events[-1]["type"] == "timings" and stages | {"llm_first_token"} <= set(events[-1]["timings"])
+
+    summaries = chain.get_stage_timings()
+    assert summaries["total"]["count"] == 3 and summaries["llm_first_token"]["count"] == 1
+    assert all(s["p50"] <= s["p95"] <= s["p99"] <= s["max"] for s in summaries.values())
+
+    assert chain.dump_stage_timings(str(tmp_path / "timings")) == len(summaries)
+    with open(tmp_path / "timings" / "stage_timings.jsonl") as f:
+        assert {json.loads(line)["stage"] for line in f} == set(summaries)
+    assert chain.get_stage_timings() == {}
+
+
+def test_stage_timings_sink_is_started_by_the_serving_endpoint_only(load_chain, tmp_path):
+    config = {"stage_timings": {"include_in_response": False, "sink_path": str(tmp_path / "timings"), "dump_interval_seconds": 3600}}
+    chain = load_chain(retriever_config=config)
+    assert not any(t.name == "stage_timings_sink" for t in threading.enumerate())
+
+    thread = chain.start_stage_timings_sink()
+
+    assert thread.is_alive() and thread.daemon
+
+
+def test_pack_context_deduplicates_and_respects_the_budget(load_chain):
+    chain = load_chain()
+
+    def doc(i, text):
+        return Document(page_content=text, metadata={"id": i, "url": "dbfs:/Volumes/catalog/schema/volume/pdfs/manual.pdf", "page_number": 0})
+
+    torque = doc(1, "Tighten the wheel nuts to 450 Nm in a crosswise sequence.")
+    drum = doc(2, "Check the brake drum for cracks and measure its inner diameter.")
+    retrievals = [
+        [drum, torque, doc(3, "Tighten the wheel nuts to 450 Nm in a crosswise  sequence.")],  # near duplicate of 1
+        [torque, doc(4, "Grease the bearing.")],
+        [torque, drum],
+    ]
+
+    context = chain.pack_context(retrievals)
+    # Retrieved by all three queries, the torque chunk comes first; each chunk appears once
+    assert context == chain.format_context([torque, drum, doc(4, "Grease the bearing.")])
+
+    tokens = chain.tokenizer.get().count(chain.format_context([torque]))
+    chain.context_config["max_tokens"] = tokens + 1
+    assert chain.pack_context(retrievals) == chain.format_context([torque])
+    chain.context_config["max_tokens"] = tokens // 2
+    assert chain.tokenizer.get().count(chain.pack_context(retrievals)) <= tokens // 2 + 1
@@ -0,0 +1,19 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+sys.path.append('./tests')
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from fake_databricks import ANSWER, FakeChatModel, load_chain_module
+
+
+@pytest.fixture
+def load_chain(tmp_path, monkeypatch):
+    # Imports a fresh `MAGGIE.chain` against fake Databricks clients, with `rag_chain_config.yaml` written to the cwd
+    def load(retriever_config: dict = None, chat_model: GenericFakeChatModel = None, embeddings: DeterministicFakeEmbedding = None):
+        monkeypatch.chdir(tmp_path)
+        return load_chain_module(monkeypatch.setattr, tmp_path, retriever_config, chat_model, embeddings)
+
+    yield load
+    sys.modules.pop("MAGGIE.chain", None)
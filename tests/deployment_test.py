@@ -0,0 +1,49 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import itertools
+import json
+import os
+import mlflow
+from langchain_core.messages import AIMessage
+from fake_databricks import ANSWER, FakeChatModel
+from MAGGIE.deployment import chain_signature
+
+QUESTION = {"messages": [{"role": "user", "content": "How do I replace the brake pads?"}]}
+
+
+class CountingChatModel(FakeChatModel):
+    calls: list = []
+
+    def _generate(self, *args, **kwargs):
+        self.calls.append(1)
+        return super()._generate(*args, **kwargs)
+
+
+def test_logged_chain_receives_the_optional_inputs(load_chain, tmp_path):
+    model = CountingChatModel(messages=itertools.cycle([AIMessage(content=ANSWER)]))
+    chain = load_chain(chat_model=model)
+    directory = os.path.dirname(os.path.abspath(chain.__file__))
+    mlflow.set_tracking_uri(f"file://{tmp_path}/mlruns")
+    with mlflow.start_run(experiment_id=mlflow.create_experiment("chain")):
+        logged_chain_info = mlflow.langchain.log_model(
+            lc_model=os.path.join(directory, "chain.py"),
+            model_config=str(tmp_path / "rag_chain_config.yaml"),
+            artifact_path="chain",
+            code_paths=[os.path.join(directory, "page_store.py")],
+            signature=chain_signature(QUESTION, "answer"),
+        )
+    served = mlflow.pyfunc.load_model(logged_chain_info.model_uri)
+
+    response = json.loads(served.predict({**QUESTION, "reference_mode": "lazy", "return_timings": True})[0])
+    assert all("reference_id" in r for r in response["references"]) and "total" in response["timings"]
+
+    # Served from the answer cache, unless it's bypassed
+    calls = len(model.calls)
+    assert json.loads(served.predict({**QUESTION, "reference_mode": "lazy"})[0])["answer"] == ANSWER
+    assert len(model.calls) == calls
+    served.predict({**QUESTION, "reference_mode": "lazy", "bypass_cache": True})
+    assert len(model.calls) > calls
+
+    # Without the optional inputs: the messages reach the chain as they were sent
+    assert "timings" not in json.loads(served.predict(QUESTION)[0])
@@ -0,0 +1,73 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from MAGGIE.embedding_client import EmbeddingClient, get_embedding_client, http_predict_fn
+
+
+class FakeEmbeddingEndpoint(BaseHTTPRequestHandler):
+    calls = []
+    throttle_first = True
+
+    def do_POST(self):
+        inputs = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['input']
+        FakeEmbeddingEndpoint.calls.append(len(inputs))
+
+        if FakeEmbeddingEndpoint.throttle_first:
+            FakeEmbeddingEndpoint.throttle_first = False
+            return self._reply(429, {"error": "rate limited"})
+        if any('poison' in text for text in inputs):
+            return self._reply(400, {"error": "bad input"})
+        return self._reply(200, {"data": [{"embedding": [float(len(text))]} for text in inputs]})
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint_url():
+    FakeEmbeddingEndpoint.calls = []
+    FakeEmbeddingEndpoint.throttle_first = True
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeEmbeddingEndpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/invocations"
+    server.shutdown()
+
+
+def test_batches_respect_item_and_token_limits():
+    client = EmbeddingClient("fake", predict_fn=lambda x: x, max_batch_size=3, max_batch_tokens=10, token_counter=len)
+    batches = client._make_batches(["aaaa", "bbbb", "c", "d", "e", "fffffffffff", "g"])
+    assert batches == [[0, 1, 2], [3, 4], [5], [6]]
+
+
+def test_embed_retries_and_isolates_failing_inputs(endpoint_url):
+    client = EmbeddingClient("fake", predict_fn=http_predict_fn(endpoint_url), max_batch_size=4, max_workers=2, backoff_base=0.01)
+    texts = ["a" * i for i in range(1, 8)] + ["poison"]
+
+    embeddings = client.embed(texts)
+
+    assert embeddings[:7] == [[float(i)] for i in range(1, 8)]
+    assert embeddings[7] is None
+    assert client.report()['failed'] == 1
+    assert client.throughput() > 0
+    # the throttled request has been retried and the rejected batch split down to the failing input
+    assert FakeEmbeddingEndpoint.calls.count(1) >= 1
+
+
+def test_clients_are_shared_per_endpoint_and_settings():
+    client = get_embedding_client("embeddings-test", max_batch_size=16, max_workers=2)
+
+    assert get_embedding_client("embeddings-test", max_workers=2, max_batch_size=16) is client
+    other = get_embedding_client("embeddings-test", max_batch_size=32, max_workers=2)
+    assert other is not client and other.max_batch_size == 32
@@ -0,0 +1,182 @@
+"""
+Fake Databricks clients and backend for `MAGGIE.chain`, shared by the tests and benchmarks/async_chain_benchmark.py.
+
+The synchronous path goes through fake LangChain objects, the async one through `fake_backend_transport`, an in-process
+HTTP transport answering the REST calls of `chain.AsyncDatabricksClient`. Both serve the same documents and answer, and
+can wait `latency` seconds per call to stand for the network round trips.
+"""
+import sys
+import copy
+import asyncio
+import importlib
+import itertools
+import json
+import time
+import httpx
+import yaml
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+ANSWER = "Loosen the wheel nuts, lift the axle and remove the brake pads with a 24 mm socket wrench."
+
+# Same shape as utils.RAG_CONFIG, without the Databricks resources
+CHAIN_CONFIG = {
+    "databricks_resources": {"llm_endpoint_name": "llm", "vector_search_endpoint_name": "vs"},
+    "llm_config": {
+        "llm_parameters": {"max_tokens": 100, "temperature": 0.0},
+        "llm_prompt_template": "Answer from this context: {context}",
+        "llm_system_prompt_rewrite": "",
+        "tools_prompt_addition": "",
+        "output_rewrite_template": "{chat_history}",
+        "output_rewrite_template_variables": ["chat_history"],
+    },
+    "retriever_config": {
+        "embedding_model": "embeddings",
+        "chunk_template": "Passage: {chunk_text}\nSource: Page {page_nr} from {document_uri}\n",
+        "query_rewrite_template": "Chat history: {chat_history}\nQuestion: {question}",
+        "query_rewrite_template_variables": ["chat_history", "question"],
+        "parameters": {"k": 3, "query_type": "ann"},
+        "schema": {"chunk_text": "content", "document_uri": "url", "primary_key": "id", "page_nr": "page_number"},
+        "vector_search_index": "catalog.schema.index",
+        "uri_prefix": "https://example.com/",
+        "page_images": {"root": "/Volumes/catalog/schema/volume/page_images", "resolution": "full", "format": "webp"},
+        "image_cache": {"max_pdf_mb": 16, "max_page_image_mb": 16},
+        "reference_images": {"max_workers": 4, "time_budget_seconds": 5},
+        "retrieval": {"max_concurrent_requests": 4},
+        "reference_mode": "inline",
+        "query_cache": {"max_entries": 100, "ttl_seconds": 3600, "index_version_refresh_seconds": 60},
+        "precomputed_answers": {"path": "/Volumes/catalog/schema/volume/precomputed_answers.json", "refresh_seconds": 300},
+        "answer_cache": {"enabled": True, "max_entries": 100, "max_mb": 16, "ttl_seconds": 3600, "similarity_threshold": 0.97},
+        "async_serving": {"max_concurrent_requests": 64, "max_connections": 100, "timeout_seconds": 10},
+        "context": {"max_tokens": 1000, "encoding": "cl100k_base", "near_duplicate_threshold": 0.9},
+        "stage_timings": {"include_in_response": False, "sink_path": None, "dump_interval_seconds": 0},
+    },
+}
+
+DOCUMENTS = [
+    Document(page_content=f"chunk {i}", metadata={"id": i, "url": f"dbfs:/Volumes/catalog/schema/volume/pdfs/manual_{i % 2}.pdf", "page_number": i})
+    for i in range(3)
+]
+
+
+class FakeChatModel(GenericFakeChatModel):
+    # Answers (or, when streamed, starts answering) after `latency` seconds and emits a token every `token_delay` seconds
+    latency: float = 0.
+    token_delay: float = 0.
+
+    def _generate(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return super()._generate(*args, **kwargs)
+
+    def _stream(self, *args, **kwargs):
+        for chunk in super()._stream(*args, **kwargs):
+            time.sleep(self.token_delay)
+            yield chunk
+
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    latency: float = 0.
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return super().embed_documents(texts)
+
+
+class FakeIndex:
+    def describe(self):
+        return {"status": {"triggered_update_status": {"last_processed_commit_version": 1}}}
+
+
+class FakeVectorSearchClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_index(self, *args, **kwargs):
+        return FakeIndex()
+
+
+class FakeVectorSearch:
+    documents = DOCUMENTS
+    latency = 0.
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        time.sleep(self.latency)
+        return self.documents[:k]
+
+
+class FakeFiles:
+    def download(self, path):
+        raise FileNotFoundError(path)
+
+
+class FakeConfig:
+    host = "https://workspace.example.com"
+
+    def authenticate(self):
+        return {"Authorization": "Bearer token"}
+
+
+class FakeWorkspaceClient:
+    def __init__(self, *args, **kwargs):
+        self.files = FakeFiles()
+        self.config = FakeConfig()
+
+
+def fake_backend_transport(latency: float = 0., embedding_size: int = 16) -> httpx.MockTransport:
+    # Answers the serving endpoints, Vector Search and Files API calls of `chain.AsyncDatabricksClient`
+    embeddings = DeterministicFakeEmbedding(size=embedding_size)
+    columns = CHAIN_CONFIG["retriever_config"]["schema"]
+
+    async def handle(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        path = request.url.path
+        if path.startswith("/serving-endpoints/"):
+            body = json.loads(request.content)
+            if "messages" in body:
+                return httpx.Response(200, json={"choices": [{"message": {"role": "assistant", "content": ANSWER}}]})
+            return httpx.Response(200, json={"data": [{"index": i, "embedding": v} for i, v in enumerate(embeddings.embed_documents(body["input"]))]})
+        if path.startswith("/api/2.0/vector-search/indexes/"):
+            names = [columns["primary_key"], columns["chunk_text"], columns["document_uri"], columns["page_nr"], "score"]
+            rows = [[d.metadata["id"], d.page_content, d.metadata["url"], d.metadata["page_number"], 0.9] for d in DOCUMENTS[:json.loads(request.content)["num_results"]]]
+            return httpx.Response(200, json={"manifest": {"columns": [{"name": n} for n in names]}, "result": {"data_array": rows}})
+        return httpx.Response(404)
+
+    return httpx.MockTransport(handle)
+
+
+def load_chain_module(setattr, directory, retriever_config: dict = None, chat_model: GenericFakeChatModel = None, embeddings: DeterministicFakeEmbedding = None):
+    # Imports a fresh `MAGGIE.chain` against the fake clients, with `rag_chain_config.yaml` written to `directory`,
+    # which must be the cwd. `setattr` is the builtin or `monkeypatch.setattr`.
+    import databricks.sdk
+    import databricks.vector_search.client
+    import langchain_community.chat_models
+    import langchain_community.embeddings
+    import langchain_community.vectorstores
+    import mlflow.langchain
+
+    config = copy.deepcopy(CHAIN_CONFIG)
+    # Sections are updated, not replaced: {"answer_cache": {"enabled": False}} keeps the other answer cache settings
+    for key, value in (retriever_config or {}).items():
+        if isinstance(value, dict) and isinstance(config["retriever_config"].get(key), dict):
+            config["retriever_config"][key].update(value)
+        else:
+            config["retriever_config"][key] = value
+    with open(f"{directory}/rag_chain_config.yaml", "w") as f:
+        yaml.dump(config, f)
+
+    model = chat_model or FakeChatModel(messages=itertools.cycle([AIMessage(content=ANSWER)]))
+    embeddings = embeddings or FakeEmbeddings(size=16)
+    setattr(mlflow.langchain, "autolog", lambda *args, **kwargs: None)
+    setattr(databricks.vector_search.client, "VectorSearchClient", FakeVectorSearchClient)
+    setattr(databricks.sdk, "WorkspaceClient", FakeWorkspaceClient)
+    setattr(langchain_community.embeddings, "DatabricksEmbeddings", lambda endpoint: embeddings)
+    setattr(langchain_community.chat_models, "ChatDatabricks", lambda endpoint, extra_params: model)
+    setattr(langchain_community.vectorstores, "DatabricksVectorSearch", FakeVectorSearch)
+
+    sys.modules.pop("MAGGIE.chain", None)
+    return importlib.import_module("MAGGIE.chain")
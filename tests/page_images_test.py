@@ -0,0 +1,29 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import io
+import pymupdf
+from PIL import Image
+from MAGGIE.page_images import page_image_path, write_page_images
+
+
+def make_document(nr_pages: int) -> pymupdf.Document:
+    doc = pymupdf.open()
+    for i in range(nr_pages):
+        page = doc.new_page(width=720, height=360)
+        page.insert_text((50, 50), f"page {i}", fontsize=20)
+    return doc
+
+
+def test_write_page_images_fills_the_store(tmp_path):
+    root = str(tmp_path)
+    path = '/Volumes/catalog/schema/volume/pdfs/manual.pdf'
+    rows = list(write_page_images(make_document(3), path, root, {'thumbnail': 36, 'full': 72}, 'webp', start=1))
+
+    assert [(r['page_number'], r['resolution']) for r in rows] == [(1, 'thumbnail'), (1, 'full'), (2, 'thumbnail'), (2, 'full')]
+    for row in rows:
+        assert row['image_path'] == page_image_path(root, path, row['page_number'], row['resolution'], 'webp')
+        with open(row['image_path'], 'rb') as f:
+            img = Image.open(io.BytesIO(f.read()))
+        assert img.format == 'WEBP'
+        assert img.size == ((360, 180) if row['resolution'] == 'thumbnail' else (720, 360))
@@ -0,0 +1,72 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from MAGGIE.fetching import PartListFetcher
+
+
+class FakePartListSite(BaseHTTPRequestHandler):
+    requests = []
+    unavailable_once = set()
+
+    def do_GET(self):
+        FakePartListSite.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path in FakePartListSite.unavailable_once:
+            FakePartListSite.unavailable_once.remove(self.path)
+            return self._reply(503, b'')
+        if self.path == '/missing':
+            return self._reply(404, b'')
+
+        etag = f'"{self.path}-v1"'
+        if self.headers.get('If-None-Match') == etag:
+            return self._reply(304, b'', etag)
+        return self._reply(200, f'<html><body>part list {self.path}</body></html>'.encode(), etag)
+
+    def _reply(self, status, body, etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def base_url():
+    FakePartListSite.requests = []
+    FakePartListSite.unavailable_once = {'/flaky'}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakePartListSite)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_fetch_all_uses_the_html_cache(base_url, tmp_path):
+    urls = [f"{base_url}/parts/{i}" for i in range(10)]
+
+    fetcher = PartListFetcher(cache_dir=str(tmp_path), max_workers=4)
+    first = dict(fetcher.fetch_all(urls))
+    assert fetcher.stats['downloaded'] == 10
+
+    # A new run (e.g. the next daily job) only receives 304s and serves the pages from disk
+    fetcher = PartListFetcher(cache_dir=str(tmp_path), max_workers=4)
+    second = dict(fetcher.fetch_all(urls))
+    assert fetcher.stats == {'downloaded': 0, 'not_modified': 10, 'failed': 0}
+    assert first == second
+    assert first[urls[3]] == b'<html><body>part list /parts/3</body></html>'
+
+
+def test_fetch_retries_and_reports_failures(base_url, tmp_path):
+    fetcher = PartListFetcher(cache_dir=str(tmp_path), backoff_factor=0.01)
+
+    assert fetcher.fetch(f"{base_url}/flaky") is not None
+    assert [path for path, _ in FakePartListSite.requests].count('/flaky') == 2
+
+    with pytest.warns(UserWarning):
+        assert fetcher.fetch(f"{base_url}/missing") is None
+    assert fetcher.stats['failed'] == 1
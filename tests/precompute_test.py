@@ -0,0 +1,68 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import hashlib
+import pytest
+from fake_databricks import FakeIndex, FakeVectorSearchClient
+from MAGGIE import precompute
+from MAGGIE.precompute import AnswerPrecomputer, prompt_fingerprint, read_index_version
+
+
+class DescribedIndex:
+    def __init__(self, status: dict) -> None:
+        self.status = status
+
+    def describe(self):
+        return {"status": self.status}
+
+
+class RecordingChain:
+    def __init__(self) -> None:
+        self.inputs = []
+
+    def invoke(self, inputs):
+        self.inputs.append(inputs)
+        if "broken" in inputs["messages"][-1]["content"]:
+            raise TimeoutError("llm")
+        return f"answer to {inputs['messages'][-1]['content']}"
+
+
+@pytest.fixture
+def precomputer(monkeypatch):
+    monkeypatch.setattr(precompute, "VectorSearchClient", FakeVectorSearchClient)
+    return AnswerPrecomputer("models:/maggie/1", "vs", "catalog.schema.index", max_workers=2)
+
+
+def test_index_version_is_the_one_the_chain_reads():
+    assert read_index_version(FakeIndex()) == "1"
+    assert read_index_version(DescribedIndex({"continuous_update_status": {"last_processed_commit_version": 7}})) == "7"
+    assert read_index_version(DescribedIndex({"indexed_row_count": 120})) == "120"
+    assert read_index_version(DescribedIndex({})) is None
+
+
+def test_prompt_fingerprint_is_the_one_the_chain_looks_up(load_chain):
+    chain = load_chain()
+    prompt = "How do I  Replace the brake pads?\n"
+
+    assert prompt_fingerprint(prompt) == hashlib.sha256(chain.normalize_query(prompt).encode("utf-8")).hexdigest()
+
+
+def test_answers_bypass_the_cache_and_skip_failed_prompts(monkeypatch, precomputer):
+    chain = RecordingChain()
+    monkeypatch.setattr(precompute.mlflow.langchain, "load_model", lambda model_uri: chain)
+
+    with pytest.warns(UserWarning, match="broken"):
+        answers = precomputer.answer(["brake pads", "broken prompt"])
+
+    assert answers == ["answer to brake pads", None]
+    assert all(inputs["bypass_cache"] and inputs["reference_mode"] == precompute.PRECOMPUTED_REFERENCE_MODE for inputs in chain.inputs)
+
+
+def test_nothing_is_precomputed_for_an_unknown_index_version(monkeypatch, precomputer, tmp_path):
+    precomputer.index = DescribedIndex({})
+    monkeypatch.setattr(precomputer, "enumerate_prompts", lambda *args, **kwargs: pytest.fail("prompts enumerated"))
+
+    with pytest.warns(UserWarning, match="unknown"):
+        precomputer.run("part_lists", "precomputed_answers", str(tmp_path / "snapshot.json"))
+
+    assert not (tmp_path / "snapshot.json").exists()
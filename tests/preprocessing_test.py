@@ -0,0 +1,61 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import pyarrow as pa
+import pymupdf
+from MAGGIE import preprocessing
+from MAGGIE.preprocessing import chunk_pdfs, find_qr_codes
+
+BROKEN_PAGE = 3
+
+
+def make_pdf(nr_pages: int, title: str = None) -> bytes:
+    doc = pymupdf.open()
+    for i in range(nr_pages):
+        page = doc.new_page(width=720, height=360)
+        page.insert_text((50, 50), f"# Page {i}\n\nTighten the wheel nuts to {100 + i} Nm.", fontsize=20)
+    if title is not None:
+        doc.set_metadata({'title': title})
+    return doc.tobytes()
+
+
+def work_units(directory, pdfs: dict, nr_pages: int) -> pa.RecordBatch:
+    # Each task reads the PDF of its unit from the volume, here a temporary directory
+    urls = []
+    for name, content in pdfs.items():
+        (directory / f"{name}.pdf").write_bytes(content)
+        urls.append(f"dbfs:{directory}/{name}.pdf")
+    return pa.RecordBatch.from_pydict({
+        'path': urls,
+        'page_start': [0] * len(urls),
+        'page_end': [nr_pages] * len(urls),
+    })
+
+
+def test_partially_parsed_document_only_emits_a_failure_row(monkeypatch, tmp_path):
+    # The broken manual raises on page N after its first pages were parsed: none of them may reach the upsert,
+    # otherwise the stale-chunk delete would drop the indexed chunks of its remaining pages
+    iter_pdf_pages = preprocessing.iter_pdf_pages
+
+    def raise_on_page(reference, start=0, end=None, **kwargs):
+        for title, page_number, text in iter_pdf_pages(reference, start=start, end=end, **kwargs):
+            if 'broken' in title and page_number == BROKEN_PAGE:
+                raise ValueError("corrupted content stream")
+            yield title, page_number, text
+
+    monkeypatch.setattr(preprocessing, 'iter_pdf_pages', raise_on_page)
+    batch = work_units(tmp_path, {name: make_pdf(5, title=name) for name in ['broken', 'healthy']}, 5)
+
+    rows = pa.Table.from_batches(chunk_pdfs({}, embed=False)(iter([batch]))).to_pylist()
+
+    broken = [r for r in rows if 'broken' in r['path']]
+    assert broken == [dict(path=f"{tmp_path}/broken.pdf", title=None, url=f"dbfs:{tmp_path}/broken.pdf", page_number=None, page_hash=None, chunk_index=None, content=None, embedding=None)]
+    assert sorted({r['page_number'] for r in rows if 'healthy' in r['path']}) == list(range(5))
+
+
+def test_unreadable_document_only_emits_a_failure_row(tmp_path):
+    batch = work_units(tmp_path, {'broken': b'%PDF-1.7 truncated', 'healthy': make_pdf(2)}, 2)
+
+    rows = pa.Table.from_batches(find_qr_codes(iter([batch]))).to_pylist()
+
+    assert rows == [dict(path=f"{tmp_path}/broken.pdf", page_number=None, qr_code_url=None)]
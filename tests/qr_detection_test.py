@@ -0,0 +1,40 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import cv2
+import pymupdf
+from MAGGIE.qr_detection import _merge_overlapping, iter_qr_codes
+
+
+def qr_code_png(url: str) -> bytes:
+    img = cv2.resize(cv2.QRCodeEncoder.create().encode(url), None, fx=8, fy=8, interpolation=cv2.INTER_NEAREST)
+    return cv2.imencode('.png', cv2.copyMakeBorder(img, 32, 32, 32, 32, cv2.BORDER_CONSTANT, value=255))[1].tobytes()
+
+
+def make_pdf(path, urls: dict, nr_pages: int) -> str:
+    # `urls`: page number -> URL of the QR code printed on that page
+    doc = pymupdf.open()
+    for i in range(nr_pages):
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((50, 50), f"Page {i}", fontsize=20)
+        if i in urls:
+            page.insert_image(pymupdf.Rect(200, 300, 400, 500), stream=qr_code_png(urls[i]))
+    doc.save(path)
+    return str(path)
+
+
+def test_parallel_scan_finds_the_codes_of_every_page_range(tmp_path):
+    first = make_pdf(tmp_path / "first.pdf", {0: "https://example.com/parts/1", 3: "https://example.com/parts/2"}, 4)
+    second = make_pdf(tmp_path / "second.pdf", {2: "https://example.com/parts/3"}, 3)
+
+    found = set(iter_qr_codes([first, str(tmp_path / "missing.pdf"), second], workers=2, pages_per_task=1))
+
+    assert found == {(first, 0, "https://example.com/parts/1"), (first, 3, "https://example.com/parts/2"), (second, 2, "https://example.com/parts/3")}
+
+
+def test_overlapping_regions_are_merged_transitively():
+    # B overlaps A and C, A doesn't overlap C: one region, whatever the order
+    a, b, c = pymupdf.Rect(0, 0, 10, 10), pymupdf.Rect(8, 0, 22, 10), pymupdf.Rect(20, 0, 30, 10)
+
+    assert _merge_overlapping([a, c, b]) == [pymupdf.Rect(0, 0, 30, 10)]
+    assert _merge_overlapping([a, pymupdf.Rect(50, 50, 60, 60)]) == [a, pymupdf.Rect(50, 50, 60, 60)]
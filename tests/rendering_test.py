@@ -0,0 +1,45 @@
+import sys
+sys.path.append('./src')
+sys.path.append('./src/MAGGIE')
+import numpy as np
+import pymupdf
+import pytest
+from MAGGIE.rendering import PageRasterizer
+
+
+def make_document() -> pymupdf.Document:
+    doc = pymupdf.open()
+    page = doc.new_page(width=300, height=200)
+    page.insert_text((20, 40), "Wheel hub cap", fontsize=18, color=(0.8, 0.1, 0.1))
+    page.draw_rect(pymupdf.Rect(150, 80, 260, 170), color=(0, 0, 1), fill=(0.2, 0.7, 0.3))
+    page.draw_line((10, 190), (290, 110), color=(0, 0, 0), width=2)
+    return doc
+
+
+@pytest.mark.parametrize("grayscale", [False, True])
+@pytest.mark.parametrize("clip", [None, pymupdf.Rect(140, 70, 270, 180)])
+def test_render_matches_get_pixmap(grayscale, clip):
+    doc = make_document()
+    page = doc[0]
+    pix = page.get_pixmap(dpi=144, clip=clip, colorspace=pymupdf.csGRAY if grayscale else pymupdf.csRGB)
+    expected = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    if grayscale:
+        expected = expected[..., 0]
+
+    rasterizer = PageRasterizer(dpi=144, grayscale=grayscale)
+    img = rasterizer.render(page, clip=clip)
+
+    assert img.shape == expected.shape
+    assert np.abs(img.astype(int) - expected.astype(int)).max() <= 1
+
+
+def test_render_reuses_the_pixmap_of_same_sized_pages():
+    doc = make_document()
+    page = doc[0]
+    rasterizer = PageRasterizer(dpi=72)
+
+    first = rasterizer.render(page, copy=True)
+    second = rasterizer.render(page)
+
+    assert rasterizer.allocations == 1
+    assert np.array_equal(first, second)